@@ -0,0 +1,42 @@
+import sys
+import time
+from collections import deque
+
+
+# width in seconds of each bucket of the expiry wheel
+BUCKET_SIZE = 15
+
+
+class ExpiringStore:
+    """Timestamps keyed by tuples of ids, forgotten once they're more than `ttl` seconds old."""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.entries = {}
+        # (bucket number, keys set during it), oldest first
+        self.buckets = deque()
+
+    def get(self, key, default=0):
+        return self.entries.get(key, default)
+
+    def __setitem__(self, key, when):
+        self.entries[key] = when
+        bucket = int(when // BUCKET_SIZE)
+        if not self.buckets or self.buckets[-1][0] < bucket:
+            self.buckets.append((bucket, set()))
+            self.sweep()
+        self.buckets[-1][1].add(key)
+
+    def sweep(self):
+        cutoff = time.time() - self.ttl
+        while len(self.buckets) > 1 and (self.buckets[0][0] + 1) * BUCKET_SIZE < cutoff:
+            _, keys = self.buckets.popleft()
+            for key in keys:
+                if self.entries.get(key, cutoff) < cutoff:
+                    del self.entries[key]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def nbytes(self):
+        return sys.getsizeof(self.entries) + sum(sys.getsizeof(keys) for _, keys in self.buckets)
@@ -0,0 +1,248 @@
+"""Offline benchmarks for the matching hot path.
+
+    python bench.py --users 500 --triggers 20 --messages 2000 --save baseline.json
+    python bench.py --users 500 --triggers 20 --messages 2000 --compare baseline.json
+    python bench.py --modes inline,thread,process
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+import discord
+
+import utils
+from matching import merge_filters, regex_of_fixed, compile_plan, patterns_of_plan, literals_of_plan, successes_of_message, record_of
+from engine import PatternSet
+from offload import Matcher
+
+
+WORDS = [
+    "the", "a", "is", "it", "that", "this", "what", "why", "how", "just", "like", "really", "about", "think", "know",
+    "rust", "python", "haskell", "brainfuck", "befunge", "compiler", "parser", "regex", "lambda", "monad", "type",
+    "bot", "server", "channel", "highlight", "trigger", "message", "discord", "esolang", "golf", "turing", "tarpit",
+    "c++", "f#", "node.js", ":)", "lol", "ok", "yes", "no", "hello", "thanks", "please", "sorry", "wait", "what?",
+]
+REGEXES = [
+    r"\bbrain\w*", r"(?:py|rb|js)thon", r"[0-9]{3,}", r"\bhigh(?:light)?s?\b", r"^!\w+", r"https?://\S+",
+    r"(?:foo|bar|baz)+", r"\b(?:c|f)[+#]{1,2}", r"l(?:o|0)+l", r"\bt[uo]ring\b",
+]
+EMOJIS = ["👍", "👀", "⭐", "<:kek:123456789012345678>"]
+
+# ids for the single guild every message is sent in
+GUILD_ID = 1
+CHANNEL_IDS = range(10, 30)
+# how often the loop lag probe wakes up, in seconds
+TICK = 0.001
+
+
+def stand_in_message(content, rng):
+    channel_id = rng.choice(CHANNEL_IDS)
+    return SimpleNamespace(
+        content=content,
+        guild=SimpleNamespace(id=GUILD_ID),
+        channel=SimpleNamespace(id=channel_id, parent_id=None),
+        author=SimpleNamespace(id=rng.randrange(1000, 1100), bot=rng.random() < 0.05),
+        reactions=[SimpleNamespace(emoji=e) for e in rng.sample(EMOJIS, rng.randrange(3))],
+        type=discord.MessageType.default,
+        reference=None,
+    )
+
+def synthetic_filter(rng):
+    r = rng.random()
+    if r < 0.6:
+        return {"type": "literal", "text": " ".join(rng.sample(WORDS, rng.choice((1, 1, 1, 2)))), "negate": False}
+    elif r < 0.8:
+        return {"type": "regex", "regex": rng.choice(REGEXES), "flags": rng.choice(("", "i", "s", "is")), "negate": False}
+    elif r < 0.85:
+        return {"type": "react", "emoji": rng.choice(EMOJIS), "negate": False}
+    elif r < 0.9:
+        return {"type": "guild", "id": rng.choice((GUILD_ID, 2)), "negate": False}
+    elif r < 0.95:
+        return {"type": "channel", "id": rng.choice(CHANNEL_IDS), "negate": rng.random() < 0.5}
+    else:
+        return {"type": "author", "id": rng.randrange(1000, 1100), "negate": True}
+
+def synthetic_config(users, triggers, rng):
+    config = {}
+    for user_id in range(users):
+        highlights = []
+        for n in range(triggers):
+            filters = [synthetic_filter(rng) for _ in range(rng.choice((1, 1, 2, 3)))]
+            if rng.random() < 0.1:
+                filters.append({"type": "bot", "negate": True})
+            highlights.append({"name": f"t{n}", "filters": filters, "noglobal": rng.random() < 0.1})
+        if rng.random() < 0.2:
+            highlights.append({"name": "global", "filters": [{"type": "author", "id": rng.randrange(1000, 1100), "negate": True}], "noglobal": False})
+        config[str(user_id)] = {"highlights": highlights}
+    return config
+
+def synthetic_corpus(messages, rng):
+    return [" ".join(rng.choices(WORDS, k=rng.choice((1, 3, 8, 20, 60)))) for _ in range(messages)]
+
+
+def timed(f, items):
+    start = time.perf_counter()
+    for item in items:
+        f(item)
+    elapsed = time.perf_counter() - start
+    return {"per_sec": len(items) / elapsed}
+
+def latencies(f, items):
+    samples = []
+    for item in items:
+        start = time.perf_counter()
+        f(item)
+        samples.append(time.perf_counter() - start)
+    samples.sort()
+    return {
+        "per_sec": len(samples) / sum(samples),
+        "p50_ms": samples[len(samples) // 2] * 1000,
+        "p99_ms": samples[min(len(samples) - 1, len(samples) * 99 // 100)] * 1000,
+    }
+
+def with_memory(f):
+    tracemalloc.start()
+    try:
+        result = f()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, peak // 1024
+
+
+async def loop_lag(matcher, plans, engine, messages):
+    # every message is handled in its own task like a gateway event, while a probe measures how late the loop wakes it up
+    lags = []
+    done = False
+
+    async def probe():
+        while not done:
+            start = time.perf_counter()
+            await asyncio.sleep(TICK)
+            lags.append(time.perf_counter() - start - TICK)
+
+    async def handle(m):
+        return await matcher.match(plans, record_of(m), None, engine)
+
+    prober = asyncio.create_task(probe())
+    start = time.perf_counter()
+    tasks = []
+    for m in messages:
+        tasks.append(asyncio.create_task(handle(m)))
+        await asyncio.sleep(0)
+    results = await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - start
+    done = True
+    await prober
+
+    lags.sort()
+    return results, {
+        "per_sec": len(messages) / elapsed,
+        "lag_p50_ms": lags[len(lags) // 2] * 1000,
+        "lag_p99_ms": lags[min(len(lags) - 1, len(lags) * 99 // 100)] * 1000,
+        "lag_max_ms": lags[-1] * 1000,
+    }
+
+def run(args):
+    rng = random.Random(args.seed)
+    config = synthetic_config(args.users, args.triggers, rng)
+    corpus = synthetic_corpus(args.messages, rng)
+    messages = [stand_in_message(content, rng) for content in corpus]
+    highlights = [h for user in config.values() for h in user["highlights"]]
+    literals = [f["text"] for h in highlights for f in h["filters"] if f["type"] == "literal"]
+    regexes = [(f["regex"], f["flags"]) for h in highlights for f in h["filters"] if f["type"] == "regex"]
+
+    results = {}
+    results["merge_filters"] = timed(lambda h: merge_filters(h["filters"]), highlights)
+    results["regex_of_fixed"] = timed(regex_of_fixed, literals)
+
+    utils.pool.clear()
+    results["matches"] = timed(lambda m: [utils.matches(r, m.content, f) for r, f in regexes[:50]], messages)
+
+    utils.pool.clear()
+    plans = {}
+    compile_stats, peak = with_memory(lambda: timed(lambda id: plans.__setitem__(id, compile_plan(config[id])), list(config)))
+    results["compile_plan"] = {**compile_stats, "peak_kb": peak}
+
+    keys = set()
+    literals = {}
+    for plan in plans.values():
+        keys |= patterns_of_plan(plan)
+        literals |= literals_of_plan(plan)
+    engine, peak = with_memory(lambda: PatternSet(keys, literals))
+    results["pattern_set"] = {"patterns": len(keys), "peak_kb": peak}
+
+    results["successes_direct"] = latencies(lambda m: [successes_of_message(p, m) for p in plans.values()], messages)
+
+    def with_engine(m):
+        scan = engine.scan(m.content)
+        return [successes_of_message(p, m, scan=scan) for p in plans.values()]
+    results["successes_engine"] = latencies(with_engine, messages)
+
+    mismatches = sum(with_engine(m) != [successes_of_message(p, m) for p in plans.values()] for m in messages)
+    if mismatches:
+        print(f"warning: the engine disagreed with direct matching on {mismatches} messages")
+
+    direct = [[successes_of_message(p, m) for p in plans.values()] for m in messages]
+    for mode in args.modes.split(","):
+        matcher = Matcher(mode, args.workers)
+        try:
+            matched, results[f"loop_lag_{mode}"] = asyncio.run(loop_lag(matcher, plans, engine, messages))
+        finally:
+            matcher.shutdown()
+        if mismatches := sum(a != b for a, b in zip(matched, direct)):
+            print(f"warning: {mode} matching disagreed with direct matching on {mismatches} messages")
+
+    return results
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, stats in results.items():
+        old = baseline.get(name, {})
+        if "per_sec" in stats and "per_sec" in old and stats["per_sec"] < old["per_sec"] * (1 - tolerance):
+            regressions.append(f"{name}: {old['per_sec']:.1f}/s -> {stats['per_sec']:.1f}/s")
+        for key in ("p99_ms", "lag_p99_ms"):
+            if key in stats and key in old and stats[key] > old[key] * (1 + tolerance):
+                regressions.append(f"{name}: {key} {old[key]:.3f}ms -> {stats[key]:.3f}ms")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the matching hot path against synthetic configs.")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--triggers", type=int, default=10)
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--modes", default="inline,thread", help="comma-separated matching modes to measure loop lag for (inline, thread, process)")
+    parser.add_argument("--workers", type=int, default=2, help="pool size for the thread and process modes")
+    parser.add_argument("--save", metavar="FILE", help="write the results to FILE as a baseline")
+    parser.add_argument("--compare", metavar="FILE", help="fail if the results are worse than the baseline in FILE")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="fraction a result may be worse than the baseline by")
+    args = parser.parse_args()
+
+    results = run(args)
+    for name, stats in results.items():
+        print(f"{name:20} " + "  ".join(f"{k}={v:.3f}" if isinstance(v, float) else f"{k}={v}" for k, v in stats.items()))
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({"params": vars(args) | {"save": None, "compare": None}, "results": results}, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if any(baseline["params"].get(k) != getattr(args, k) for k in ("users", "triggers", "messages", "seed")):
+            print("warning: baseline was recorded with different parameters")
+        if regressions := compare(results, baseline["results"], args.tolerance):
+            print("regressions:", *regressions, sep="\n  ")
+            sys.exit(1)
+        print("no regressions")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+import asyncio
+import time
+from collections import OrderedDict, deque
+
+import discord
+
+
+# how long fetched context is shared between deliveries of the same message
+CONTEXT_TTL = 15
+# how many recent messages to remember per channel, or 0 to always fetch context over REST
+RECENT_MESSAGES = 50
+# how many channels to remember recent messages for. the one that went longest without a message is dropped first
+RECENT_CHANNELS = 1000
+# how long a message fetched for a reaction is reused
+MESSAGE_TTL = 30
+
+
+class ContextCache:
+    """The two messages either side of a highlighted message, shared between everyone it's delivered to."""
+
+    def __init__(self, ttl=CONTEXT_TTL, recent=RECENT_MESSAGES, channels=RECENT_CHANNELS):
+        self.ttl = ttl
+        self.size = recent
+        self.channels = channels
+        # channel id -> deque of its latest messages, least recently active first
+        self.recent = OrderedDict() if recent else None
+        # message id -> (expiry, task fetching the context)
+        self.contexts = {}
+
+    def add(self, message):
+        if self.recent is None:
+            return
+        id = message.channel.id
+        if (buf := self.recent.get(id)) is not None:
+            self.recent.move_to_end(id)
+        else:
+            buf = self.recent[id] = deque(maxlen=self.size)
+            if len(self.recent) > self.channels:
+                self.recent.popitem(last=False)
+        buf.append(message)
+
+    def forget(self, channel_id, message_id):
+        # anything before a deleted or edited message is dropped so the buffer stays contiguous and up to date
+        if self.recent is None or not (buf := self.recent.get(channel_id)):
+            return
+        for idx, message in enumerate(buf):
+            if message.id == message_id:
+                for _ in range(idx + 1):
+                    buf.popleft()
+                break
+
+    def forget_channel(self, channel_id):
+        if self.recent is not None:
+            self.recent.pop(channel_id, None)
+
+    def reset(self):
+        if self.recent is not None:
+            self.recent.clear()
+
+    def from_recent(self, msg):
+        if self.recent is None or not (buf := self.recent.get(msg.channel.id)):
+            return None
+        buf = list(buf)
+        for idx, message in enumerate(buf):
+            if message.id == msg.id:
+                break
+        else:
+            return None
+        if idx < 2:
+            # there might be older messages we never saw
+            return None
+        return buf[idx-2:idx], buf[idx+1:idx+3]
+
+    async def get(self, msg):
+        if (context := self.from_recent(msg)) is not None:
+            return context
+
+        now = time.monotonic()
+        while self.contexts:
+            id, (expiry, _) = next(iter(self.contexts.items()))
+            if expiry > now:
+                break
+            del self.contexts[id]
+
+        try:
+            _, task = self.contexts[msg.id]
+        except KeyError:
+            task = asyncio.create_task(self.fetch(msg))
+            self.contexts[msg.id] = now + self.ttl, task
+        try:
+            return await asyncio.shield(task)
+        except Exception:
+            self.contexts.pop(msg.id, None)
+            raise
+
+    async def fetch(self, msg):
+        before = [x async for x in msg.channel.history(before=msg, limit=2)][::-1]
+        after = [x async for x in msg.channel.history(after=msg, limit=2)]
+        return before, after
+
+
+class MessageCache:
+    """Messages fetched for reaction events, kept briefly so a burst of reactions only fetches once."""
+
+    def __init__(self, ttl=MESSAGE_TTL):
+        self.ttl = ttl
+        # message id -> (expiry, task fetching the message)
+        self.messages = {}
+        # message id -> [(emoji, delta)] for reactions that came in while the message was being fetched
+        self.pending = {}
+
+    def expire(self):
+        now = time.monotonic()
+        while self.messages:
+            id, (expiry, _) = next(iter(self.messages.items()))
+            if expiry > now:
+                break
+            del self.messages[id]
+
+    async def fetch(self, channel, message_id):
+        self.expire()
+        try:
+            _, task = self.messages[message_id]
+        except KeyError:
+            self.pending[message_id] = []
+            task = asyncio.create_task(self.fetch_fresh(channel, message_id))
+            self.messages[message_id] = time.monotonic() + self.ttl, task
+        try:
+            return await asyncio.shield(task)
+        except Exception:
+            self.messages.pop(message_id, None)
+            raise
+
+    async def fetch_fresh(self, channel, message_id):
+        try:
+            message = await channel.fetch_message(message_id)
+        finally:
+            deltas = self.pending.pop(message_id, ())
+        # discord may have answered before or after each of these, so a reaction the message already has is taken to be in it
+        for emoji, delta in deltas:
+            adjust(message, emoji, delta, seen=delta > 0)
+        return message
+
+    def react(self, message_id, emoji, delta):
+        # keep the reactions of an already fetched message up to date, and save them for one still being fetched
+        if message_id in self.pending:
+            self.pending[message_id].append((emoji, delta))
+            return
+        entry = self.messages.get(message_id)
+        if not entry or not entry[1].done() or entry[1].exception():
+            return
+        adjust(entry[1].result(), emoji, delta)
+
+    def forget(self, message_id):
+        self.messages.pop(message_id, None)
+        self.pending.pop(message_id, None)
+
+def adjust(message, emoji, delta, seen=False):
+    for reaction in message.reactions:
+        if str(reaction.emoji) == str(emoji):
+            if not seen:
+                reaction.count += delta
+                if reaction.count <= 0:
+                    message.reactions.remove(reaction)
+            break
+    else:
+        if delta > 0:
+            message.reactions.append(discord.Reaction(message=message, data={"count": delta, "me": False}, emoji=emoji))  # type: ignore
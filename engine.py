@@ -0,0 +1,143 @@
+import asyncio
+from collections import defaultdict
+
+import re2 as re
+
+from utils import options_of
+from literals import LiteralAutomaton, supported
+from matching import search
+import metrics
+
+
+# RE2 sets report no match at all if their DFA runs out of memory, so we keep each one small
+SET_SIZE = 256
+# how many literals may be added or removed since a guild's automaton was built before it's built again, at least
+AUTOMATON_SLACK = 64
+
+
+def compile_set(flags, regexes):
+    options = options_of(flags)
+    options.log_errors = False
+    s = re.Set.SearchSet(options)
+    added = {}
+    for regex in regexes:
+        try:
+            added[s.Add(regex)] = regex, flags
+        except re.error:
+            pass
+    if not added:
+        return None
+    try:
+        s.Compile()
+    except re.error:
+        return None
+    return s, added
+
+def shard_count(n, previous=None):
+    # about half a set per shard. the previous count is kept while it's still reasonable, so sets aren't all rebuilt each time n crosses a boundary
+    if previous and n <= previous * SET_SIZE and (previous == 1 or n >= previous * SET_SIZE // 4):
+        return previous
+    shards = 1
+    while n > shards * SET_SIZE // 2:
+        shards *= 2
+    return shards
+
+class PatternSet:
+    def __init__(self, keys, literals={}, previous=None):
+        # plain literals go through one automaton, and everything else through RE2 sets grouped by flags.
+        # whatever is unchanged since the previous build is reused rather than compiled again
+        literals = {k: t for k, t in literals.items() if k in keys and supported(t)}
+        items = frozenset(literals.items())
+        old = previous.automaton.texts if previous and previous.automaton else frozenset()
+        drift = len(items - old) + len(old - items)
+        if old and drift <= max(AUTOMATON_SLACK, len(items) // 8):
+            # the old automaton keeps serving. literals added since go through the RE2 sets, and hits on removed ones are ignored
+            self.automaton = previous.automaton
+            in_automaton = {k for k, _ in items & old}
+            self.removed = {k for k, _ in old - items} - set(literals)
+        else:
+            self.automaton = LiteralAutomaton(literals) if literals else None
+            in_automaton = set(literals)
+            self.removed = set()
+        self.known = set(in_automaton)
+
+        by_flags = defaultdict(list)
+        for regex, flags in keys:
+            if (regex, flags) not in in_automaton:
+                by_flags[flags].append(regex)
+
+        # each set holds one shard of the regexes with some flags, so adding or removing one only rebuilds its own shard
+        self.shards = {}
+        self.chunks = {}
+        for flags, regexes in by_flags.items():
+            shards = self.shards[flags] = shard_count(len(regexes), previous and previous.shards.get(flags))
+            by_shard = defaultdict(list)
+            for regex in regexes:
+                by_shard[hash(regex) % shards].append(regex)
+            for regexes in by_shard.values():
+                regexes.sort()
+                for i in range(0, len(regexes), SET_SIZE):
+                    chunk = flags, tuple(regexes[i:i+SET_SIZE])
+                    if previous and chunk in previous.chunks:
+                        compiled = previous.chunks[chunk]
+                    else:
+                        compiled = compile_set(*chunk)
+                    if compiled:
+                        self.chunks[chunk] = compiled
+                        self.known.update(compiled[1].values())
+
+    def scan(self, content):
+        hits = self.automaton.scan(content) - self.removed if self.automaton else set()
+        for s, added in self.chunks.values():
+            for idx in s.Match(content) or ():
+                hits.add(added[idx])
+        return Scan(self.known, hits)
+
+class Scan:
+    def __init__(self, known, hits):
+        self.known = known
+        self.hits = hits
+
+    def matched(self, pattern, content):
+        if pattern.key in self.known:
+            return pattern.key in self.hits
+        # added after the engine was last built
+        metrics.count("engine", "fallback")
+        return search(pattern, content)
+
+EMPTY = PatternSet(set())
+
+
+class Engines:
+    def __init__(self, keys_of_guild):
+        self.keys_of_guild = keys_of_guild
+        self.engines = {}
+        self.stale = set()
+        self.task = None
+
+    def get(self, guild_id):
+        if guild_id not in self.engines and guild_id not in self.stale:
+            self.invalidate([guild_id])
+        return self.engines.get(guild_id, EMPTY)
+
+    def invalidate(self, guild_ids):
+        self.stale.update(guild_ids)
+        if self.stale and (not self.task or self.task.done()):
+            self.task = asyncio.create_task(self.rebuild())
+
+    async def rebuild(self):
+        # the old engine keeps serving while we work, so there's never a window where patterns are missed
+        while self.stale:
+            guild_id = self.stale.pop()
+            keys, literals = self.keys_of_guild(guild_id)
+            with metrics.timer("engine_build"):
+                self.engines[guild_id] = await asyncio.to_thread(PatternSet, keys, literals, self.engines.get(guild_id))
+
+    async def wait(self):
+        # until every stale engine has been rebuilt
+        while self.task and not self.task.done():
+            await asyncio.shield(self.task)
+
+    def discard(self, guild_id):
+        self.engines.pop(guild_id, None)
+        self.stale.discard(guild_id)
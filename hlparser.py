@@ -1,3 +1,4 @@
+import os
 import unicodedata
 
 import re2 as re
@@ -5,12 +6,24 @@ import parse_discord
 import discord
 from discord.ext import commands
 
-from utils import matches
+from utils import matches, options_of
+
+
+# RE2 program size (roughly, instructions) above which a regex is refused, and above which the user is warned about it
+MAX_PROGRAM_SIZE = int(os.environ.get("HIGHLIGHT_MAX_PROGRAM_SIZE", 2000))
+WARN_PROGRAM_SIZE = int(os.environ.get("HIGHLIGHT_WARN_PROGRAM_SIZE", 300))
+# memory RE2 may use to compile a regex at parse time, in bytes
+MAX_MEM = int(os.environ.get("HIGHLIGHT_MAX_MEM", 256 << 10))
+# the longest a trigger read from a file may be when it goes over several lines, which is the most a message can hold
+MAX_TRIGGER_LENGTH = 4000
 
 
 class LexFailure(ValueError):
     pass
 
+class Unterminated(LexFailure):
+    pass
+
 quotes = {
     '"': '"',
     "'": "'",
@@ -68,12 +81,12 @@ class StringView:
             self.fail("expected EOF or whitespace after quoted word")
         except commands.errors.ExpectedClosingQuoteError:
             self.idx = v.index
-            self.fail("reached EOF while parsing a quoted word")
+            self.fail("reached EOF while parsing a quoted word", error=Unterminated)
         else:
             self.idx = v.index
             return w
 
-    def fail(self, msg, help_msg=None):
+    def fail(self, msg, help_msg=None, error=LexFailure):
         e = f"error: {msg}\n"
         n = 0
         for line in self.string.splitlines():
@@ -83,7 +96,7 @@ class StringView:
                 n = -float('inf')
             n += len(line)
         e += f"help: {help_msg}" if help_msg else ""
-        raise LexFailure(e)
+        raise error(e)
 
     def skip_ws(self):
         while self.peek().isspace() or self.peek() == "`":
@@ -102,7 +115,7 @@ class StringView:
             s = ""
             while self.peek() != end:
                 if self.is_eof:
-                    self.fail("reached EOF while parsing quoted string")
+                    self.fail("reached EOF while parsing quoted string", error=Unterminated)
                 c = self.peek()
                 if c == "\\":
                     self.consume()
@@ -128,7 +141,7 @@ class StringView:
             escaping = False
             while True:
                 if self.is_eof:
-                    self.fail("reached EOF while parsing regular expression")
+                    self.fail("reached EOF while parsing regular expression", error=Unterminated)
                 c = self.peek()
                 self.consume()
                 if c == "/" and not escaping:
@@ -144,10 +157,16 @@ class StringView:
                 flags += self.peek()
                 self.consume()
 
+            options = options_of(flags)
+            options.max_mem = MAX_MEM
             try:
-                re.compile(p)
+                compiled = re.compile(p, options)
             except re.error as e:
+                if b"too large" in e.args[0]:
+                    self.fail("regex is too expensive", "use fewer alternatives or smaller repetition counts")
                 self.fail(f"regex is invalid: {e.args[0].decode()}")
+            if compiled.programsize > MAX_PROGRAM_SIZE:
+                self.fail(f"regex is too expensive (program size {compiled.programsize}, the limit is {MAX_PROGRAM_SIZE})", "use fewer alternatives or smaller repetition counts")
 
             if matches(p, "", ""):
                 self.fail("regex should not match the empty string", "if you want to match any message, you don't need to provide a regex condition")
@@ -207,11 +226,25 @@ class StringView:
             return {"type": "bot", "negate": negate}
         elif self.consume_literal("reply"):
             return {"type": "reply", "negate": negate}
+        elif self.is_eof:
+            self.fail("expected a condition after negation")
         else:
             self.fail(f"unknown start of token '{self.peek()}' ({unicodedata.name(self.peek()).title()})", "wrap literal strings in quotes and regular expressions in slashes")
 
+def quote_word(word):
+    # written so that get_quoted_word reads it back unchanged
+    if word[0] in commands.view._quotes or any(c.isspace() for c in word):
+        return '"' + word.replace('"', '\\"') + '"'
+    return word[0] + "".join("\\"*(c in commands.view._all_quotes) + c for c in word[1:])
+
+def quote_string(text):
+    # written so that lex_rule reads it back unchanged
+    return '"' + text.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
 def parse(text, ctx):
-    view = StringView(text, ctx.bot)
+    return parse_view(StringView(text, ctx.bot), ctx)
+
+def parse_view(view, ctx):
     view.skip_ws()
     filters = []
     noglobal = False
@@ -226,3 +259,56 @@ def parse(text, ctx):
             filters.append(rule)
         view.skip_ws()
     return filters, noglobal
+
+def parse_line(line, ctx, commands=()):
+    # the output of `raw`, with or without the mention and command name in front
+    view = StringView(line, ctx.bot)
+    view.skip_ws()
+    start = view.idx
+    word = view.get_quoted_word() or ""
+    if re.fullmatch("<@!?[0-9]+>", word):
+        view.skip_ws()
+        start = view.idx
+        word = view.get_quoted_word() or ""
+    if word not in commands:
+        view.idx = start
+    # only whitespace, since a name may start with a backtick
+    while view.peek().isspace():
+        view.consume()
+    name = view.get_quoted_word()
+    if not name:
+        view.fail("expected a trigger name")
+    filters, noglobal = parse_view(view, ctx)
+    return name, filters, noglobal
+
+def parse_many(text, ctx, commands=()):
+    # one trigger per line, though a quoted string or regex with a newline in it carries on to the next. every line is parsed so all the errors can be reported at once
+    triggers = {}
+    errors = []
+    lines = text.split("\n")
+    n = 0
+    while n < len(lines):
+        start = n
+        n += 1
+        if not lines[start].strip():
+            continue
+        first = None
+        try:
+            while True:
+                try:
+                    name, filters, noglobal = parse_line("\n".join(lines[start:n]), ctx, commands)
+                    break
+                except Unterminated as e:
+                    first = first or e
+                    if n == len(lines) or sum(map(len, lines[start:n+1])) > MAX_TRIGGER_LENGTH:
+                        # it was never closed, so it's an error on its own line
+                        n = start + 1
+                        raise first
+                    n += 1
+        except LexFailure as e:
+            errors.append(f"line {start + 1}:\n{e}")
+            continue
+        if name in triggers:
+            errors.append(f"line {start + 1}:\nerror: trigger {name!r} was already defined on line {triggers[name][0]}\n")
+        triggers[name] = start + 1, filters, noglobal
+    return {name: (filters, noglobal) for name, (_, filters, noglobal) in triggers.items()}, errors
@@ -0,0 +1,97 @@
+import asyncio
+import logging
+from collections import deque
+
+import metrics
+
+
+# how many checks run at once
+WORKERS = 8
+# how many checks may be waiting before new ones are turned away
+MAX_PENDING = 5000
+# how many checks one channel may have waiting. in a burst the oldest are dropped, since highlights from it are debounced anyway
+PER_CHANNEL = 20
+# how long a check may wait before it's too late to be worth doing, in seconds
+DEADLINE = 60
+
+log = logging.getLogger("highlight")
+
+
+class Inbox:
+    """Queue of highlight checks in front of a fixed set of workers. Channels take turns, so a spam wave in one doesn't hold up the rest."""
+
+    def __init__(self, check, workers=WORKERS, max_pending=MAX_PENDING, per_channel=PER_CHANNEL, deadline=DEADLINE):
+        self.check = check
+        self.workers = workers
+        self.max_pending = max_pending
+        self.per_channel = per_channel
+        self.deadline = deadline
+        # channel id -> deque of (time submitted, args)
+        self.waiting = {}
+        # channels with something waiting, each in here once
+        self.turns = asyncio.Queue()
+        self.tasks = []
+        self.pending = 0
+        self.active = 0
+        self.done = 0
+        self.coalesced = 0
+        self.expired = 0
+        self.overflowed = 0
+
+    def submit(self, channel_id, *args):
+        if not self.tasks:
+            self.tasks = [asyncio.create_task(self.work()) for _ in range(self.workers)]
+
+        if self.pending >= self.max_pending:
+            self.overflowed += 1
+            metrics.count("checks_shed", "overflowed")
+            return
+        try:
+            queue = self.waiting[channel_id]
+        except KeyError:
+            queue = self.waiting[channel_id] = deque()
+            self.turns.put_nowait(channel_id)
+        else:
+            if len(queue) >= self.per_channel:
+                queue.popleft()
+                self.pending -= 1
+                self.coalesced += 1
+                metrics.count("checks_shed", "coalesced")
+        queue.append((asyncio.get_running_loop().time(), args))
+        self.pending += 1
+
+    async def work(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            channel_id = await self.turns.get()
+            queue = self.waiting[channel_id]
+            submitted, args = queue.popleft()
+            self.pending -= 1
+            if queue:
+                # to the back of the line
+                self.turns.put_nowait(channel_id)
+            else:
+                del self.waiting[channel_id]
+
+            waited = loop.time() - submitted
+            metrics.observe("stage_seconds", waited, "queued")
+            if waited > self.deadline:
+                self.expired += 1
+                metrics.count("checks_shed", "expired")
+                continue
+
+            self.active += 1
+            try:
+                with metrics.timer("check"):
+                    await self.check(*args)
+            except Exception:
+                log.exception("checking highlights failed")
+            finally:
+                self.active -= 1
+                self.done += 1
+
+    def __len__(self):
+        return self.pending + self.active
+
+    def stats(self):
+        return {"pending": self.pending, "active": self.active, "done": self.done, "coalesced": self.coalesced, "expired": self.expired, "overflowed": self.overflowed}
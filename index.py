@@ -0,0 +1,77 @@
+from collections import defaultdict
+
+
+class InterestIndex:
+    """Which configured users could possibly be highlighted by a message in a given guild and channel."""
+
+    def __init__(self):
+        # guild id -> configured users that are members of it
+        self.members = defaultdict(set)
+        # users with at least one rule that isn't pinned to a guild or channel
+        self.unscoped = set()
+        # guild or channel id -> users with a rule pinned to it
+        self.scoped = defaultdict(set)
+        self.scopes = {}
+
+    def set_scope(self, user_id, scope):
+        old = self.scopes.pop(user_id, ())
+        if old is None:
+            self.unscoped.discard(user_id)
+        else:
+            for id in old:
+                self.scoped[id].discard(user_id)
+                if not self.scoped[id]:
+                    del self.scoped[id]
+
+        self.scopes[user_id] = scope
+        if scope is None:
+            self.unscoped.add(user_id)
+        else:
+            for id in scope:
+                self.scoped[id].add(user_id)
+
+    def add_member(self, guild_id, user_id):
+        self.members[guild_id].add(user_id)
+
+    def remove_member(self, guild_id, user_id):
+        self.members[guild_id].discard(user_id)
+
+    def remove_guild(self, guild_id):
+        self.members.pop(guild_id, None)
+
+    def candidates(self, guild_id, *channel_ids):
+        members = self.members.get(guild_id)
+        if not members:
+            return set()
+        out = members & self.unscoped
+        for id in (guild_id, *channel_ids):
+            if id in self.scoped:
+                out |= members & self.scoped[id]
+        return out
+
+
+class ReactionIndex:
+    """Which users have reaction conditions, by emoji."""
+
+    def __init__(self):
+        self.users = defaultdict(set)
+        # users with a reaction condition in their global rule, which makes any reaction relevant to them
+        self.any = set()
+        self.emojis = {}
+
+    def set_reactions(self, user_id, emojis, any_emoji):
+        for emoji in self.emojis.pop(user_id, ()):
+            self.users[emoji].discard(user_id)
+            if not self.users[emoji]:
+                del self.users[emoji]
+        self.any.discard(user_id)
+
+        if emojis:
+            self.emojis[user_id] = emojis
+        for emoji in emojis:
+            self.users[emoji].add(user_id)
+        if any_emoji:
+            self.any.add(user_id)
+
+    def interested(self, emoji):
+        return self.any | self.users.get(emoji, set())
@@ -0,0 +1,67 @@
+from collections import deque
+
+
+WORD = frozenset("0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz_")
+# RE2's case folding for ASCII letters. the kelvin sign and long s are the only non-ASCII characters it folds to them
+FOLD = str.maketrans({**{c: c.lower() for c in "ABCDEFGHIJKLMNOPQRSTUVWXYZ"}, "\u212a": "k", "\u017f": "s"})
+
+
+def supported(text):
+    # anything else stays with RE2, whose Unicode case folding we don't reproduce
+    return text.isascii()
+
+def is_boundary(content, idx):
+    # RE2's \b, which only considers ASCII word characters
+    before = idx > 0 and content[idx-1] in WORD
+    after = idx < len(content) and content[idx] in WORD
+    return before != after
+
+
+class LiteralAutomaton:
+    """Case-insensitive Aho-Corasick automaton over literal strings, with the word boundaries `regex_of_fixed` adds."""
+
+    def __init__(self, literals):
+        # literals: key -> text
+        self.texts = frozenset(literals.items())
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [()]
+
+        for key, text in literals.items():
+            state = 0
+            for c in text.translate(FOLD):
+                nxt = self.goto[state].get(c)
+                if nxt is None:
+                    nxt = self.goto[state][c] = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append(())
+                state = nxt
+            self.out[state] += ((key, len(text), text[0] in WORD, text[-1] in WORD),)
+
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for c, nxt in self.goto[state].items():
+                queue.append(nxt)
+                f = self.fail[state]
+                while f and c not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[nxt] = self.goto[f].get(c, 0) if self.goto[f].get(c) != nxt else 0
+                self.out[nxt] += self.out[self.fail[nxt]]
+
+    def scan(self, content):
+        hits = set()
+        goto, fail, out = self.goto, self.fail, self.out
+        state = 0
+        for idx, c in enumerate(content.translate(FOLD)):
+            while state and c not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(c, 0)
+            for key, length, left, right in out[state]:
+                if key in hits:
+                    continue
+                end = idx + 1
+                if (not left or is_boundary(content, end - length)) and (not right or is_boundary(content, end)):
+                    hits.add(key)
+        return hits
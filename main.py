@@ -1,23 +1,38 @@
 import asyncio
 import base64
 import datetime
+import io
+import logging
+import os
 import time
-import json
 import unicodedata
-import os
-from collections import defaultdict
+from functools import partial
 from typing import Union, Optional
 
-import re2 as re
 import discord
 from discord.utils import escape_markdown as escape
 from discord.ext import commands
 
 import hlparser as parser
-from utils import render_pattern, matches, english_list, display_message
+from utils import render_pattern, english_list, display_cached, compile_pattern, pool
+from matching import REORDER_INTERVAL, merge_filters, compile_plan, order_plan, patterns_of_plan, pins_of_plan, literals_of_plan, reactions_of_plan, scope_of_plan, size_of_highlight, successes_of_message, explain_of_message, record_of
+from engine import Engines
+from offload import Matcher
+from index import InterestIndex, ReactionIndex
+from scheduler import Scheduler
+from storage import Config, SqliteBackend
+from activity import ExpiringStore
+from context import ContextCache, MessageCache
+from outbox import Outbox
+from inbox import Inbox
+from state import ThreadMembers, PermissionCache, ConfiguredMembers
 from help import HighlightHelpCommand
+import metrics
 
 
+started = time.monotonic()
+log = logging.getLogger("highlight")
+
 intents = discord.Intents(
     guilds=True,
     messages=True,
@@ -28,6 +43,9 @@ intents = discord.Intents(
     voice_states=True,
 )
 
+# set HIGHLIGHT_MEMBER_CACHE=configured to only cache the members who have a config, instead of every member of every guild
+configured_only = os.environ.get("HIGHLIGHT_MEMBER_CACHE") == "configured"
+
 bot = commands.Bot(
     command_prefix=commands.when_mentioned,
     description="A highlighting bot that DMs you when someone says something that matches a preconfigured set of criteria.",
@@ -35,21 +53,52 @@ bot = commands.Bot(
     allowed_mentions=discord.AllowedMentions(everyone=False),
     intents=intents,
     help_command=HighlightHelpCommand(),
+    # voice states are kept by the guild either way, so `Member.voice` works for everyone we cache
+    member_cache_flags=discord.MemberCacheFlags.none() if configured_only else discord.MemberCacheFlags.from_intents(intents),
+    chunk_guilds_at_startup=not configured_only,
 )
+background = set()
 async def setup():
     await bot.load_extension("jishaku")
+    background.add(asyncio.create_task(metrics.write_periodically("metrics.prom")))
+    background.add(asyncio.create_task(reorder_plans()))
+    await warm_plans()
 bot.setup_hook = setup
-last_active = defaultdict(float)
-last_highlight = defaultdict(float)
 
-try:
-    with open("config.json") as f:
-        config = json.load(f)
-except FileNotFoundError:
-    config = {}
+# a JSON config beside it with the same name is imported the first time
+CONFIG_PATH = os.environ.get("HIGHLIGHT_CONFIG", "config.db")
+config = Config(SqliteBackend(CONFIG_PATH, import_from=f"{os.path.splitext(CONFIG_PATH)[0]}.json"))
+
+last_active = ExpiringStore(30)
+last_highlight = ExpiringStore(10)
+scheduler = Scheduler()
+context = ContextCache()
+messages = MessageCache()
+threads = ThreadMembers()
+permissions = PermissionCache()
+outbox = Outbox()
+
+metrics.gauge("users", lambda: len(config))
+metrics.gauge("last_active_entries", lambda: len(last_active))
+metrics.gauge("last_active_bytes", lambda: last_active.nbytes())
+metrics.gauge("last_highlight_entries", lambda: len(last_highlight))
+metrics.gauge("last_highlight_bytes", lambda: last_highlight.nbytes())
+metrics.gauge("scheduled_deliveries", lambda: len(scheduler))
+for name in ("pending", "sent", "dropped", "retried"):
+    metrics.gauge(f"outbox_{name}", lambda name=name: outbox.stats()[name])
+for name in ("pending", "coalesced", "expired", "overflowed"):
+    metrics.gauge(f"inbox_{name}", lambda name=name: inbox.stats()[name])
+for name in ("patterns", "pinned", "program_size", "evictions", "compile_seconds"):
+    metrics.gauge(f"pattern_pool_{name}", lambda name=name: pool.stats()[name])
+
+def mark_active(channel_id, user_id, when=None):
+    if str(user_id) not in config:
+        return
+    last_active[(channel_id, user_id)] = when or time.time()
+    scheduler.cancel((channel_id, user_id))
 
 def get_user(member):
-    return config.setdefault(str(member.id), {"highlights": []})
+    return config.user(str(member.id))
 
 settings = {
     "before_time": ("delay-before", "Delay before", "Highlights don't work if you're active in the channel. "
@@ -80,41 +129,98 @@ for opt, (cmd_name, _, description, _, conv) in settings.items():
     def g(opt=opt):
         @_settings.command(name=cmd_name, brief=description, help=description)
         async def c(ctx, v: conv):  # type: ignore
-            user = get_user(ctx.author)
-            user[opt] = v
-            save()
+            config.set_option(str(ctx.author.id), opt, v)
+            update_windows()
             await ctx.send("👍")
     g()
 
 def get_config(user, v):
     return user.get(v, settings[v][3])
 
-def save():
-    with open("config.json.new", "w") as f:
-        json.dump(config, f)
-    os.replace("config.json.new", "config.json")
-
+def update_windows():
+    # activity and debounce state only has to be kept for as long as the longest window anyone has set
+    last_active.ttl = max((get_config(user, "before_time") for user in config.values()), default=settings["before_time"][3])
+    last_highlight.ttl = max((get_config(user, "debounce_time") for user in config.values()), default=settings["debounce_time"][3])
 
-regex_cache = {}
-def matches(regex, content, flags):
-    key = (regex, flags)
+update_windows()
 
+plans = {}
+def get_plan(id):
     try:
-        o = regex_cache[key]
+        return plans[id]
     except KeyError:
-        options = re.Options()
-        if "i" in flags:
-            options.case_sensitive = False
-        if "s" in flags:
-            options.dot_nl = True
-        options.never_capture = True
-        try:
-            o = re.compile(regex, options)
-        except re.error:
-            return False
-        regex_cache[key] = o
-
-    return o.search(content)
+        plan = plans[id] = compile_plan(config[id], pin=True)
+        return plan
+
+async def warm_plans():
+    # compile everyone's triggers before connecting, rather than on the first messages that reach them.
+    # each plan is pinned as soon as it's compiled, so the pool never evicts patterns that are about to be pinned
+    ids = list(config)
+    for n, id in enumerate(ids):
+        get_plan(id)
+        if n % 100 == 99:
+            await asyncio.sleep(0)
+    log.info("compiled %d plans in %.2fs since startup", len(ids), time.monotonic() - started)
+
+async def reorder_plans():
+    while True:
+        await asyncio.sleep(REORDER_INTERVAL)
+        for id, plan in plans.items():
+            plans[id] = order_plan(plan)
+
+def invalidate_plan(member):
+    id = str(member.id)
+    if old := plans.pop(id, None):
+        pool.unpin(pins_of_plan(old))
+    if id in config:
+        index_user(id)
+        for guild in member.mutual_guilds:
+            index.add_member(guild.id, member.id)
+        if configured_only and not member.mutual_guilds:
+            # first time they've had a config, so they aren't cached anywhere yet
+            configured.request([member.id])
+    engines.invalidate(g.id for g in member.mutual_guilds)
+
+index = InterestIndex()
+reactions = ReactionIndex()
+
+def index_user(id):
+    plan = get_plan(id)
+    index.set_scope(int(id), scope_of_plan(plan))
+    reactions.set_reactions(int(id), reactions_of_plan(plan), plan.global_react)
+
+async def index_guild(guild):
+    if configured_only:
+        # members are indexed as they arrive, so matching can start with whoever is cached already
+        configured.start(guild, [int(id) for id in config])
+        return
+    for id in config:
+        if guild.get_member(int(id)):
+            index.add_member(guild.id, int(id))
+
+def members_found(guild, members):
+    for member in members:
+        # command invokers are cached too, but only people with a config are candidates
+        if str(member.id) in config:
+            index.add_member(guild.id, member.id)
+    engines.invalidate([guild.id])
+
+configured = ConfiguredMembers(lambda: bot.guilds, members_found)
+
+def pattern_keys_of_guild(guild_id):
+    keys = set()
+    literals = {}
+    for user_id in index.members.get(guild_id, ()):
+        plan = get_plan(str(user_id))
+        keys |= patterns_of_plan(plan)
+        literals |= literals_of_plan(plan)
+    return keys, literals
+
+engines = Engines(pattern_keys_of_guild)
+matcher = Matcher()
+# set once the engines have been built after startup, messages wait for it
+warm = asyncio.Event()
+
 
 def english_list(l, merger="and"):
     if len(l) == 1:
@@ -124,9 +230,9 @@ def english_list(l, merger="and"):
     else:
         return f"{', '.join(l[:-1])}, {merger} {l[-1]}"
 
-async def send_highlight(user, patterns, msg, provenance):
-    before = [x async for x in msg.channel.history(before=msg, limit=2)][::-1]
-    after = [x async for x in msg.channel.history(after=msg, limit=2)]
+async def render_highlight(patterns, msg, provenance):
+    with metrics.timer("context"):
+        before, after = await context.get(msg)
 
     lines = []
     for message in before + [None] + after:
@@ -139,35 +245,24 @@ async def send_highlight(user, patterns, msg, provenance):
         if bold:
             head_str = f"**{head_str}**"
 
-        lines.append(f"{head_str}: {display_message(message.content)}")
+        lines.append(f"{head_str}: {display_cached(message)}")
 
     embed = discord.Embed(description='\n'.join(lines))
     embed.add_field(name="\u200b", value=msg.jump_url)
 
     pattern_string = english_list([repr(x) for x in patterns])
     highlights = "Highlight" if len(patterns) == 1 else "Highlights"
+    return f'{highlights} {pattern_string} in {msg.channel.mention} (on **{msg.guild.name}**) by {provenance.mention} ({provenance.display_name})', embed
+
+async def send_highlight(user, patterns, msg, provenance):
+    content, embed = await render_highlight(patterns, msg, provenance)
     try:
-        await user.send(f'{highlights} {pattern_string} in {msg.channel.mention} (on **{msg.guild.name}**) by {provenance.mention} ({provenance.display_name})', embed=embed)
+        await user.send(content, embed=embed)
     except discord.HTTPException:
         pass
 
-def merge_filters(filters):
-    rules = defaultdict(list)
-    out_filters = []
-    for f in filters:
-        if f["type"] in ("guild", "channel", "exact_channel", "author", "reply"):
-            if not f["negate"]:
-                rules[f["type"]].append(f['id'])
-            else:
-                out_filters.append({"type": f["type"], "ids": [f["id"]], "negate": True})
-        else:
-            out_filters.append(f)
-    for k, v in rules.items():
-        out_filters.append({"type": k, "ids": list(set(v)), "negate": False})
-    return out_filters
-
 def check_single_debounce(user, key):
-    if time.time()-last_highlight[key] <= get_config(user, "debounce_time"):
+    if time.time()-last_highlight.get(key) <= get_config(user, "debounce_time"):
         if not get_config(user, "debounce_fixed"):
             last_highlight[key] = time.time()
         return False
@@ -180,69 +275,22 @@ def do_debounce(user, key, successes):
     else:
         return [success for success in successes if check_single_debounce(user, (*key, success))]
 
-def regex_of_fixed(string):
-    r = re.escape(string)
-    if re.search(r"^\w", string):
-        r = r"\b" + r
-    if re.search(r"\w$", string):
-        r = r + r"\b"
-    return r
-
-def successes_of_message(user, message, relevant_react=None):
-    successes = []
-    global_result = True
-
-    for highlight in user["highlights"]:
-        if highlight["name"] == "global" and any(f["type"] == "react" for f in highlight["filters"]):
-            # if something in the global rule is relevant, every rule is relevant
-            relevant_react = None
-            break
-
-    for highlight in user["highlights"]:
-        is_global = highlight["name"] == "global"
-        is_relevant = not relevant_react
-        for f in merge_filters(highlight["filters"]):
-            t = f["type"]
-            if t == "literal":
-                x = matches(regex_of_fixed(f['text']), message.content, "i")
-            elif t == "regex":
-                x = matches(f['regex'], message.content, f['flags'])
-            elif t == "react":
-                is_relevant = is_relevant or f['emoji'] == relevant_react
-                x = any(str(r.emoji) == f['emoji'] for r in message.reactions)
-            elif t == "guild":
-                x = message.guild.id in f['ids']
-            elif t in ("channel", "exact_channel"):
-                x = message.channel.id in f['ids'] or t == "channel" and getattr(message.channel, "parent_id", None) in f['ids']
-            elif t == "author":
-                x = message.author.id in f['ids']
-            elif t == "bot":
-                x = message.author.bot
-            elif t == "reply":
-                x = message.type == discord.MessageType.reply and message.reference.resolved and message.reference.resolved.author.id in f['ids']
-            else:
-                assert False
-            if bool(x) != (not f["negate"]):
-                break
-        else:
-            if is_relevant and not is_global:
-                successes.append(highlight)
-            continue
-        if is_global:
-            global_result = False
-
-    return [x["name"] for x in successes if global_result or x["noglobal"]]
-
 async def check_highlights(message, provenance, relevant_react=None):
     if not message.guild:
         return
+    if not warm.is_set():
+        await warm.wait()
 
     activity_matters = datetime.datetime.now(datetime.timezone.utc) - message.created_at < datetime.timedelta(minutes=5)
 
-    users_to_highlight = defaultdict(list)
-    for id, user in config.items():
-        key = message.channel.id, int(id)
-        user_obj = message.guild.get_member(int(id))
+    candidates = index.candidates(message.guild.id, message.channel.id, getattr(message.channel, "parent_id", None))
+    metrics.observe("candidates", len(candidates), buckets=metrics.COUNTS)
+    eligible = []
+    for user_id in candidates:
+        id = str(user_id)
+        user = config[id]
+        key = message.channel.id, user_id
+        user_obj = message.guild.get_member(user_id)
         if not user_obj:
             continue
 
@@ -250,65 +298,197 @@ async def check_highlights(message, provenance, relevant_react=None):
             check_single_debounce(user, key)
             continue
 
-        user_perms = message.channel.permissions_for(user_obj)
+        user_perms = permissions.get(message.channel, user_obj)
         if (not user_perms.read_messages or not user.get("enabled", True)
          or message.author.id in (blocked := user.get("blocked", [])) or message.channel.id in blocked or getattr(message.channel, "parent_id", None) in blocked):
             continue
         if message.channel.type == discord.ChannelType.private_thread:
-            try:
-                await message.channel.fetch_member(user_obj.id)
-            except discord.NotFound:
+            with metrics.timer("thread_members"):
+                thread_members = await threads.get(message.channel)
+            if user_id not in thread_members:
                 continue
+        eligible.append((id, user, user_obj, key))
+
+    if not eligible:
+        return
+    with metrics.timer("match"):
+        results = await matcher.match({id: get_plan(id) for id, *_ in eligible}, record_of(message), relevant_react, engines.get(message.guild.id))
 
+    for (id, user, user_obj, key), successes in zip(eligible, results):
         start_last_active = last_active.get(key, 0)
         activity_failure = (activity_matters or message.author == user_obj) and (
             time.time()-start_last_active <= get_config(user, "before_time")
          or user_obj.voice and user_obj.voice.channel and user_obj.voice.channel.category == message.channel.category
         )
 
-        successes = successes_of_message(user, message, relevant_react)
         successes = do_debounce(user, key, successes)
 
         if successes and not activity_failure:
-            if activity_matters:
-                await asyncio.sleep(get_config(user, "after_time"))
-                if last_active.get(key, 0) > start_last_active:
-                    # they spoke during the sleep
-                    continue
+            delay = get_config(user, "after_time") if activity_matters else 0
+            metrics.observe("stage_seconds", delay, "after_time")
+            scheduler.schedule(key, delay, partial(deliver_highlight, key, start_last_active if activity_matters else None, user_obj, successes, message, provenance))
 
-            await send_highlight(user_obj, successes, message, provenance)
+inbox = Inbox(check_highlights)
+
+async def deliver_highlight(key, start_last_active, user_obj, successes, message, provenance):
+    if start_last_active is not None and last_active.get(key, 0) > start_last_active:
+        # they spoke during the delay
+        metrics.count("highlights", "cancelled")
+        return
+    metrics.count("highlights", "delivered")
+    content, embed = await render_highlight(successes, message, provenance)
+    await outbox.submit(user_obj, content, embed)
 
 @bot.listen()
 async def on_message(message):
-    last_active[(message.channel.id, message.author.id)] = time.time()
+    mark_active(message.channel.id, message.author.id)
 
     if not message.guild:
         return
 
-    await check_highlights(message, message.author)
+    # context is only ever needed where someone could be highlighted
+    if index.candidates(message.guild.id, message.channel.id, getattr(message.channel, "parent_id", None)):
+        context.add(message)
+    metrics.count("events", "message")
+    inbox.submit(message.channel.id, message, message.author)
 
 @bot.event
 async def on_raw_reaction_add(payload):
-    last_active[(payload.channel_id, payload.user_id)] = time.time()
+    mark_active(payload.channel_id, payload.user_id)
 
     if not payload.guild_id:
         return
 
-    msg = await bot.get_channel(payload.channel_id).fetch_message(payload.message_id)
+    messages.react(payload.message_id, payload.emoji, 1)
+    if not index.members.get(payload.guild_id, set()) & reactions.interested(str(payload.emoji)):
+        # nobody here has a rule this reaction could set off
+        return
+
+    metrics.count("events", "reaction")
+    with metrics.timer("fetch_message"):
+        msg = await messages.fetch(bot.get_channel(payload.channel_id), payload.message_id)
     if any(str(r.emoji) == str(payload.emoji) and r.count == 1 for r in msg.reactions):
-        await check_highlights(msg, payload.member, str(payload.emoji))
+        inbox.submit(msg.channel.id, msg, payload.member, str(payload.emoji))
 
 @bot.event
 async def on_raw_reaction_remove(payload):
-    last_active[(payload.channel_id, payload.user_id)] = time.time()
+    mark_active(payload.channel_id, payload.user_id)
+    messages.react(payload.message_id, payload.emoji, -1)
+
+@bot.event
+async def on_raw_reaction_clear(payload):
+    messages.forget(payload.message_id)
+
+@bot.event
+async def on_raw_reaction_clear_emoji(payload):
+    messages.forget(payload.message_id)
 
 @bot.event
 async def on_raw_message_edit(payload):
-    last_active[(payload.channel_id, payload.data["author"]["id"])] = time.time()
+    metrics.count("events", "edit")
+    context.forget(payload.channel_id, payload.message_id)
+    messages.forget(payload.message_id)
+    mark_active(payload.channel_id, int(payload.data["author"]["id"]))
+
+@bot.event
+async def on_raw_message_delete(payload):
+    context.forget(payload.channel_id, payload.message_id)
+    messages.forget(payload.message_id)
 
 @bot.event
 async def on_typing(channel, user, when):
-    last_active[(channel.id, user.id)] = when.timestamp()
+    metrics.count("events", "typing")
+    mark_active(channel.id, user.id, when.timestamp())
+
+@bot.listen()
+async def on_thread_member_join(member):
+    threads.join(member.thread_id, member.id)
+
+@bot.listen()
+async def on_raw_thread_member_remove(payload):
+    for id in payload.data.get("removed_member_ids", []):
+        threads.leave(payload.thread_id, int(id))
+
+@bot.listen()
+async def on_thread_update(before, after):
+    if after.archived:
+        threads.forget(after.id)
+
+@bot.listen()
+async def on_thread_remove(thread):
+    threads.forget(thread.id)
+
+@bot.listen()
+async def on_raw_thread_delete(payload):
+    threads.forget(payload.thread_id)
+    context.forget_channel(payload.thread_id)
+
+@bot.listen()
+async def on_guild_role_create(role):
+    permissions.forget_guild(role.guild.id)
+
+@bot.listen()
+async def on_guild_role_update(before, after):
+    permissions.forget_guild(after.guild.id)
+
+@bot.listen()
+async def on_guild_role_delete(role):
+    permissions.forget_guild(role.guild.id)
+
+@bot.listen()
+async def on_guild_update(before, after):
+    if before.owner_id != after.owner_id:
+        permissions.forget_guild(after.id)
+
+@bot.listen()
+async def on_guild_channel_update(before, after):
+    permissions.forget_channel(after.guild.id, after.id)
+
+@bot.listen()
+async def on_guild_channel_delete(channel):
+    permissions.forget_channel(channel.guild.id, channel.id)
+    context.forget_channel(channel.id)
+
+@bot.listen()
+async def on_ready():
+    # we may have missed messages while disconnected
+    context.reset()
+    for id in config:
+        index_user(id)
+    await asyncio.gather(*(index_guild(guild) for guild in bot.guilds))
+    if not warm.is_set():
+        engines.invalidate(g.id for g in bot.guilds)
+        await engines.wait()
+        warm.set()
+        log.info("ready to match after %.2fs: %d plans, %d patterns, %d guild engines", time.monotonic() - started, len(plans), pool.stats()["patterns"], len(engines.engines))
+
+@bot.listen()
+async def on_guild_join(guild):
+    await index_guild(guild)
+
+@bot.listen()
+async def on_guild_remove(guild):
+    index.remove_guild(guild.id)
+    permissions.forget_guild(guild.id)
+    engines.discard(guild.id)
+
+@bot.listen()
+async def on_member_join(member):
+    if str(member.id) not in config:
+        return
+    if configured_only:
+        # discord.py doesn't keep it, but we've been handed it so there's no need to ask the gateway
+        member.guild._add_member(member)
+    members_found(member.guild, [member])
+
+@bot.before_invoke
+async def cache_invoker(ctx):
+    if configured_only and ctx.guild and not ctx.guild.get_member(ctx.author.id):
+        configured.request([ctx.author.id])
+
+@bot.listen()
+async def on_member_remove(member):
+    index.remove_member(member.guild.id, member.id)
 
 @bot.command(aliases=["list"])
 async def show(ctx):
@@ -319,7 +499,8 @@ async def show(ctx):
     embed = discord.Embed(title="Your highlight triggers" + " are disabled"*(not user.get("enabled", True)), description="")
     embed.set_author(name=ctx.author.display_name, icon_url=ctx.author.avatar)
 
-    for highlight in user["highlights"]:
+    sizes = [size_of_highlight(h) for h in get_plan(str(ctx.author.id)).highlights]
+    for highlight, size in zip(user["highlights"], sizes):
         n = []
         for f in merge_filters(highlight["filters"]):
             t = f["type"]
@@ -352,7 +533,7 @@ async def show(ctx):
             elif t == "reply":
                 n.append(f"**is{d}** a reply to you")
         noglobal = " (noglobal)"*highlight["noglobal"]
-        line = f"{escape(highlight['name'])}{noglobal}: {english_list(n)}\n"
+        line = f"{escape(highlight['name'])}{noglobal} (cost {size}): {english_list(n)}\n"
         embed.description += line  # type: ignore
 
     if not user["highlights"]:
@@ -360,27 +541,42 @@ async def show(ctx):
     elif len(user["highlights"]) == 1:
         embed.set_footer(text="Sometimes just one is all you need")
     else:
-        embed.set_footer(text=f"Listed {len(user['highlights'])} triggers")
+        embed.set_footer(text=f"Listed {len(user['highlights'])} triggers, costing {sum(sizes)} in total")
 
     await ctx.send(embed=embed)
 
 
+def default_filters(ctx, name):
+    filters = [{"type": "literal", "text": name, "negate": False}]
+    if ctx.guild:
+        filters.append({"type": "guild", "id": ctx.guild.id, "negate": False})
+    return filters
+
+def expensive_patterns(filters):
+    # patterns that got past the parser's limit but are still heavy
+    heavy = []
+    for f in filters:
+        if f["type"] == "regex" and (size := compile_pattern(f["regex"], f["flags"]).programsize) > parser.WARN_PROGRAM_SIZE:
+            heavy.append(f"{render_pattern(f['regex'], f['flags'])} (cost {size})")
+    return heavy
+
 def add_highlight(ctx, name, filters=None, noglobal=False):
-    if not filters:
-        filters = [{"type": "literal", "text": name, "negate": False}]
-        if ctx.guild:
-            filters.append({"type": "guild", "id": ctx.guild.id, "negate": False})
-    highlights = get_user(ctx.author)["highlights"]
-    for highlight in highlights:
-        if highlight["name"] == name:
-            highlight["filters"] = filters
-            highlight["noglobal"] = noglobal
-            break
-    else:
-        highlights.append({"name": name, "filters": filters, "noglobal": noglobal})
-    save()
+    config.put_highlight(str(ctx.author.id), name, filters or default_filters(ctx, name), noglobal)
+    invalidate_plan(ctx.author)
+
+def add_highlights(ctx, triggers):
+    config.put_highlights(str(ctx.author.id), {name: (filters or default_filters(ctx, name), noglobal) for name, (filters, noglobal) in triggers.items()})
+    invalidate_plan(ctx.author)
 
 
+def is_confusing(ctx, name, filters, noglobal):
+    # it's suspicious if the name of the trigger parses as a valid rule, unless it's included in the rule we have. this is probably a mistake, so we reject it.
+    try:
+        name_filters, name_noglobal = parser.parse(name, ctx)
+    except parser.LexFailure:
+        return False
+    return not all(f in filters for f in name_filters) or name_noglobal > noglobal
+
 @bot.command(rest_is_raw=True, aliases=["update", "set", "edit", "put"])
 async def add(ctx, name, *, text):
     """Add or update (upsert) a trigger. Syntax: `add trigger_name "string" /regex/ guild:Esolangs channel:#off-topic author:LyricLy`"""
@@ -393,53 +589,41 @@ async def add(ctx, name, *, text):
     except parser.LexFailure as e:
         return await ctx.send(f"Error while parsing input.\n```{e}```")
 
-    try:
-        name_filters, name_noglobal = parser.parse(name, ctx)
-    except parser.LexFailure:
-        pass
-    else:
-        if not all(f in filters for f in name_filters) or name_noglobal > noglobal:
-            # it's suspicious if the name of the trigger parses as a valid rule, unless it's included in the rule we have. this is probably a mistake, so we reject it.
-            err = f'Refusing to create trigger with confusing name `{name}`.\nI think you meant to write `{ctx.invoked_with} "{name.strip("/+'")}" {name}{text}`.'
-            return await ctx.send(err)
+    if is_confusing(ctx, name, filters, noglobal):
+        err = f'Refusing to create trigger with confusing name `{name}`.\nI think you meant to write `{ctx.invoked_with} "{name.strip("/+'")}" {name}{text}`.'
+        return await ctx.send(err)
 
     add_highlight(ctx, name, filters, noglobal)
+    if heavy := expensive_patterns(filters):
+        return await ctx.send(f"👍 Heads up: {escape(english_list(heavy))} {'is' if len(heavy) == 1 else 'are'} expensive to check. Every message in every server we share is checked against {'it' if len(heavy) == 1 else 'them'}.")
     await ctx.send("👍")
 
 @bot.command()
 async def remove(ctx, *names):
     """Remove one or more triggers by name."""
 
-    highlights = config.get(str(ctx.author.id), {"highlights": []})["highlights"]
-    to_remove = []
-    for idx, highlight in enumerate(highlights):
-        if highlight["name"] in names:
-            to_remove.append(idx-len(to_remove))
-    for idx in to_remove:
-        highlights.pop(idx)
-    save()
+    config.remove_highlights(str(ctx.author.id), names)
+    invalidate_plan(ctx.author)
     await ctx.send("👍")
 
 @bot.command()
 async def clear(ctx):
     """Clears all of your highlight triggers. Consider using `disable` instead."""
 
-    get_user(ctx.author)["highlights"] = []
-    save()
+    config.clear_highlights(str(ctx.author.id))
+    invalidate_plan(ctx.author)
     await ctx.send("👍")
 
 @bot.command()
 async def disable(ctx):
     """Disable all of your highlights."""
-    get_user(ctx.author)["enabled"] = False
-    save()
+    config.set_option(str(ctx.author.id), "enabled", False)
     await ctx.send("👍")
 
 @bot.command()
 async def enable(ctx):
     """Re-enable the bot after disabling it using `disable`."""
-    get_user(ctx.author)["enabled"] = True
-    save()
+    config.set_option(str(ctx.author.id), "enabled", True)
     await ctx.send("👍")
 
 @bot.command()
@@ -448,11 +632,70 @@ async def test(ctx, where: Optional[discord.Message]):
     if where is None:
         where = ctx.message.reference.resolved if ctx.message.reference and ctx.message.reference.resolved else ctx.message
 
-    successes = successes_of_message(get_user(ctx.author), where)
+    get_user(ctx.author)
+    successes = successes_of_message(get_plan(str(ctx.author.id)), where)
     if not successes:
         return await ctx.send("No highlight matched.")
     await send_highlight(ctx, successes, where, ctx.author)
 
+def describe_check(check):
+    t, negate, arg = check
+    d = " not" * negate
+    if t == "literal":
+        return f"does{d} contain {escape(repr(arg.literal))}"
+    elif t == "regex":
+        return f"does{d} match {escape(render_pattern(arg.regex, arg.flags))}"
+    elif t == "react":
+        return f"does{d} have a {arg} reaction"
+    elif t == "guild":
+        return f"is{d} in {english_list([f'server {escape(g.name)}' if (g := bot.get_guild(id)) else f'<unknown server {id}>' for id in arg], 'or')}"
+    elif t in ("channel", "exact_channel"):
+        return f"is{d} in {english_list([f'<#{id}>' for id in arg], 'or')}{' (excluding threads)'*(t == 'exact_channel')}"
+    elif t == "author":
+        return f"is{d} from {english_list([f'<@{id}>' for id in arg], 'or')}"
+    elif t == "bot":
+        return f"is{d} from a bot"
+    elif t == "reply":
+        return f"is{d} a reply to you"
+
+@bot.command(aliases=["profile"])
+async def explain(ctx, where: Optional[discord.Message]):
+    """Like `test`, but show how each of your triggers was checked: which condition stopped it, and what each condition cost."""
+    if where is None:
+        where = ctx.message.reference.resolved if ctx.message.reference and ctx.message.reference.resolved else ctx.message
+
+    get_user(ctx.author)
+    successes, explained, global_result = explain_of_message(get_plan(str(ctx.author.id)), where)
+
+    lines = []
+    total_seconds = 0
+    total_size = 0
+    for highlight, steps, is_relevant in explained:
+        if not steps or steps[-1].passed:
+            outcome = "matched" if is_relevant else "matched, but no reaction in it was just added"
+        else:
+            failed = steps[-1].check
+            outcome = f"stopped because it {describe_check(failed._replace(negate=not failed.negate))}"
+        lines.append(f"**{escape(highlight.name)}**{' (noglobal)'*highlight.noglobal}: {outcome}")
+        for step in steps:
+            cost = f", cost {step.size}, {'cached' if step.cached else 'not cached'}" if step.cached is not None else ""
+            lines.append(f"{'✅' if step.passed else '❌'} {describe_check(step.check)} ({step.seconds * 1000:.3f}ms{cost})")
+            total_seconds += step.seconds
+            total_size += step.size
+        if skipped := len(highlight.checks) - len(steps):
+            lines.append(f"⏭️ {skipped} more condition{'s'*(skipped != 1)} not checked")
+
+    if not global_result:
+        lines.append("Your `global` trigger didn't match, so only noglobal triggers can fire.")
+    lines.append(f"Total: {total_seconds * 1000:.3f}ms and cost {total_size} for this message.")
+    lines.append(f"Would highlight: {escape(english_list(successes))}" if successes else "No highlight matched.")
+
+    text = "\n".join(lines)
+    if len(text) > 2000:
+        await ctx.send(file=discord.File(io.BytesIO(text.encode()), "explain.txt"))
+    else:
+        await ctx.send(text, allowed_mentions=discord.AllowedMentions.none())
+
 @bot.command()
 async def raw(ctx, name):
     """Output a highlight trigger in the format used by the `add` command, to facilitate easier editing of triggers."""
@@ -463,18 +706,20 @@ async def raw(ctx, name):
     else:
         return await ctx.send("You don't have a trigger with that name.")
 
-    if any(c.isspace() or c == '"' for c in name):
-        name = name.replace('"', r'\"')
-        name = f'"{name}"'
+    await ctx.send(raw_of(highlight))
 
-    o = [bot.user.mention, "edit", name]
+def raw_of(highlight, exact=False):
+    # exact output is read back by the parser as the same trigger. otherwise regexes are wrapped in code so they show properly in a message
+    o = [bot.user.mention, "edit", parser.quote_word(highlight["name"])]
     for f in highlight["filters"]:
         t = f["type"]
         if t == "literal":
-            rep = repr(f['text'])
+            rep = parser.quote_string(f['text'])
         elif t == "regex":
-            r = render_pattern(f['regex'], f['flags']).replace('`', '`\u200b')
-            rep = f"``{r}``"
+            rep = render_pattern(f['regex'], f['flags'])
+            if not exact:
+                r = rep.replace('`', '`\u200b')
+                rep = f"``{r}``"
         elif t == "react":
             rep = f"+{f['emoji']}"
         elif t in ("guild", "channel", "exact_channel", "author"):
@@ -486,8 +731,45 @@ async def raw(ctx, name):
         elif t == "reply":
             rep = "reply"
         o.append("-"*f['negate'] + rep)
+    if highlight["noglobal"]:
+        o.append("noglobal")
 
-    await ctx.send(" ".join(o))
+    return " ".join(o)
+
+@bot.command()
+async def export(ctx):
+    """Send all of your triggers as a file, one per line in the format used by `raw`. Use `import` to load it again."""
+
+    highlights = config.get(str(ctx.author.id), {"highlights": []})["highlights"]
+    if not highlights:
+        return await ctx.send("You don't have any triggers.")
+    text = "\n".join(raw_of(h, exact=True) for h in highlights) + "\n"
+    await ctx.send(file=discord.File(io.BytesIO(text.encode()), "triggers.txt"))
+
+@bot.command(name="import")
+async def import_(ctx):
+    """Add or update every trigger in an attached file, written one per line in the format used by `raw`. Nothing is changed if any line has an error."""
+
+    if not ctx.message.attachments:
+        return await ctx.send("Attach a file of triggers, like the one `export` gives you.")
+    try:
+        text = (await ctx.message.attachments[0].read()).decode()
+    except UnicodeDecodeError:
+        return await ctx.send("That file isn't text.")
+
+    triggers, errors = parser.parse_many(text, ctx, (add.name, *add.aliases))
+    errors += [f"error: refusing to create trigger with confusing name {name!r}\n" for name, (filters, noglobal) in triggers.items() if is_confusing(ctx, name, filters, noglobal)]
+    if errors:
+        report = "\n".join(errors)
+        if len(report) > 1900:
+            return await ctx.send(f"Errors on {len(errors)} line{'s'*(len(errors) != 1)}, nothing was imported.", file=discord.File(io.BytesIO(report.encode()), "errors.txt"))
+        return await ctx.send(f"Errors on {len(errors)} line{'s'*(len(errors) != 1)}, nothing was imported.\n```{report}```")
+    if not triggers:
+        return await ctx.send("That file doesn't have any triggers in it.")
+
+    add_highlights(ctx, triggers)
+    heavy = [p for filters, _ in triggers.values() for p in expensive_patterns(filters)]
+    await ctx.send(f"👍 Imported {len(triggers)} trigger{'s'*(len(triggers) != 1)}." + f" {len(heavy)} of the patterns are expensive to check, see `show`."*bool(heavy))
 
 @bot.command()
 @commands.guild_only()
@@ -496,38 +778,57 @@ async def migrate(ctx):
 
     await ctx.send("Coolio. Do `@Highlight list` for me, please.")
     msg = await bot.wait_for("message", check=lambda m: m.author.id == 292212176494657536 and m.embeds and m.embeds[0].author.name == ctx.author.display_name)
-    for trigger in msg.embeds[0].description.splitlines():
-        add_highlight(ctx, trigger)
+    add_highlights(ctx, {trigger: ([], False) for trigger in msg.embeds[0].description.splitlines()})
     await ctx.send("👍")
 
 @bot.command()
 async def block(ctx, *, what: Union[discord.TextChannel, discord.User, discord.Thread, discord.ForumChannel]):
     """Block a user or channel from activating highlights."""
 
-    user = get_user(ctx.author)
-    blocked = user.setdefault("blocked", [])
-    if what.id in blocked:
-        await ctx.send("Already done.")
-    else:
-        blocked.append(what.id)
-        save()
+    if config.block(str(ctx.author.id), what.id):
         await ctx.send("👍")
+    else:
+        await ctx.send("Already done.")
 
 @bot.command()
 async def unblock(ctx, *, what: Union[discord.TextChannel, discord.User, discord.Thread]):
     """Unblock a user or channel."""
 
-    user = get_user(ctx.author)
-    blocked = user.setdefault("blocked", [])
-    try:
-        blocked.remove(what.id)
-    except ValueError:
+    if config.unblock(str(ctx.author.id), what.id):
+        await ctx.send("👍")
+    else:
         await ctx.send("Already done.")
+
+@bot.group(invoke_without_command=True, name="metrics")
+@commands.is_owner()
+async def _metrics(ctx):
+    """Show event counts, timings and queue sizes."""
+
+    text = metrics.summary() if metrics.enabled else "Metrics are disabled."
+    if len(text) > 1900:
+        await ctx.send(file=discord.File(io.BytesIO(text.encode()), "metrics.txt"))
     else:
-        save()
-        await ctx.send("👍")
+        await ctx.send(f"```\n{text}```")
+
+@_metrics.command(name="enable")
+@commands.is_owner()
+async def metrics_enable(ctx):
+    """Start collecting metrics."""
+    metrics.enabled = True
+    await ctx.send("👍")
+
+@_metrics.command(name="disable")
+@commands.is_owner()
+async def metrics_disable(ctx):
+    """Stop collecting metrics and throw away what's been collected."""
+    metrics.enabled = False
+    metrics.reset()
+    await ctx.send("👍")
 
 
-with open("token.txt") as f:
-    token = f.read()
-bot.run(token)
+if __name__ == "__main__":
+    with open("token.txt") as f:
+        token = f.read()
+    bot.run(token, root_logger=True)
+    matcher.shutdown()
+    config.close()
@@ -0,0 +1,293 @@
+import time
+from collections import Counter, defaultdict
+from typing import Any, NamedTuple
+
+import re2 as re
+import discord
+
+from utils import compile_pattern, pool
+
+
+class Pattern(NamedTuple):
+    regex: str
+    flags: str
+    compiled: Any
+    # the original text of literal conditions
+    literal: str | None = None
+
+    @property
+    def key(self):
+        return self.regex, self.flags
+
+    def __reduce__(self):
+        # compiled RE2 objects can't be pickled, so the receiving side compiles its own
+        return pattern_of, (self.regex, self.flags, self.literal)
+
+class Check(NamedTuple):
+    type: str
+    negate: bool
+    arg: Any
+
+class CompiledHighlight(NamedTuple):
+    name: str
+    noglobal: bool
+    is_global: bool
+    checks: tuple[Check, ...]
+
+class Plan(NamedTuple):
+    highlights: tuple[CompiledHighlight, ...]
+    global_react: bool
+
+class Step(NamedTuple):
+    # how one check went, for `explain`
+    check: Check
+    passed: bool
+    seconds: float
+    # program size, and whether the pattern pool had it, for literal and regex checks
+    size: int
+    cached: bool | None
+
+class MessageRecord(NamedTuple):
+    """The parts of a message that matching looks at, as plain values that can be sent to another thread or process."""
+    content: str
+    guild_id: int
+    channel_id: int
+    parent_id: int | None
+    author_id: int
+    author_bot: bool
+    reactions: tuple[str, ...]
+    # author of the message being replied to, if any
+    reply_to: int | None
+
+
+# checks are tried cheapest first: id and bot tests, then reactions, then text by cost and how often it rejects
+RANK = {"literal": 2, "regex": 2, "react": 1}
+# how often plans are reordered using what has been learned about the patterns in them, in seconds
+REORDER_INTERVAL = 600
+
+
+class Selectivity:
+    """How often each pattern has matched the messages it was scanned against."""
+
+    def __init__(self):
+        self.messages = 0
+        self.hits = Counter()
+
+    def observe(self, hits):
+        self.messages += 1
+        self.hits.update(hits)
+
+    def rate(self, key):
+        return (self.hits[key] + 1) / (self.messages + 2)
+
+selectivity = Selectivity()
+
+
+def merge_filters(filters):
+    rules = defaultdict(list)
+    out_filters = []
+    for f in filters:
+        if f["type"] in ("guild", "channel", "exact_channel", "author", "reply"):
+            if not f["negate"]:
+                rules[f["type"]].append(f['id'])
+            else:
+                out_filters.append({"type": f["type"], "ids": [f["id"]], "negate": True})
+        else:
+            out_filters.append(f)
+    for k, v in rules.items():
+        out_filters.append({"type": k, "ids": list(set(v)), "negate": False})
+    return out_filters
+
+def regex_of_fixed(string):
+    r = re.escape(string)
+    if re.search(r"^\w", string):
+        r = r"\b" + r
+    if re.search(r"\w$", string):
+        r = r + r"\b"
+    return r
+
+def pattern_of(regex, flags, literal=None, pin=False):
+    try:
+        compiled = compile_pattern(regex, flags, pin)
+    except re.error:
+        compiled = None
+    return Pattern(regex, flags, compiled, literal)
+
+def compile_check(f, pin=False):
+    t = f["type"]
+    if t == "literal":
+        arg = pattern_of(regex_of_fixed(f["text"]), "i", f["text"], pin)
+    elif t == "regex":
+        arg = pattern_of(f["regex"], f["flags"], pin=pin)
+    elif t == "react":
+        arg = f["emoji"]
+    elif t in ("guild", "channel", "exact_channel", "author", "reply"):
+        arg = frozenset(f["ids"])
+    else:
+        arg = None
+    return Check(t, f["negate"], arg)
+
+def compile_plan(user, pin=False):
+    # with pin, each pattern is pinned in the pool as it's compiled. pins_of_plan gives them back to unpin
+    highlights = tuple(
+        CompiledHighlight(
+            highlight["name"],
+            highlight["noglobal"],
+            highlight["name"] == "global",
+            tuple(compile_check(f, pin) for f in merge_filters(highlight["filters"])),
+        )
+        for highlight in user["highlights"]
+    )
+    # if something in the global rule is relevant, every rule is relevant
+    global_react = any(h.is_global and any(c.type == "react" for c in h.checks) for h in highlights)
+    return order_plan(Plan(highlights, global_react))
+
+def cost_of(check, stats):
+    rank = RANK.get(check.type, 0)
+    if rank < 2:
+        return rank, 0
+    size = check.arg.compiled.programsize if check.arg.compiled else 0
+    rate = stats.rate(check.arg.key)
+    rejects = rate if check.negate else 1 - rate
+    return rank, size / max(rejects, 1e-6)
+
+def order_plan(plan, stats=selectivity):
+    # a highlight fires only if all of its checks pass, and they have no side effects, so the order never changes the result.
+    # reactions are only relevant when every check passed, so they're all seen in that case as well
+    return plan._replace(highlights=tuple(
+        h._replace(checks=tuple(sorted(h.checks, key=lambda c: cost_of(c, stats))))
+        for h in plan.highlights
+    ))
+
+def patterns_of_plan(plan):
+    return {c.arg.key for h in plan.highlights for c in h.checks if c.type in ("literal", "regex") and c.arg.compiled}
+
+def pins_of_plan(plan):
+    # every pattern compile_plan pinned, once for each time it was pinned
+    return [c.arg.key for h in plan.highlights for c in h.checks if c.type in ("literal", "regex") and c.arg.compiled]
+
+def literals_of_plan(plan):
+    return {c.arg.key: c.arg.literal for h in plan.highlights for c in h.checks if c.type == "literal" and c.arg.compiled}
+
+def size_of_highlight(highlight):
+    # what a highlight costs the hot path: the RE2 program size of everything it searches for
+    return sum(c.arg.compiled.programsize for c in highlight.checks if c.type in ("literal", "regex") and c.arg.compiled)
+
+def reactions_of_plan(plan):
+    return frozenset(c.arg for h in plan.highlights for c in h.checks if c.type == "react")
+
+def scope_of_plan(plan):
+    # the guilds and channels this plan can possibly fire in, or None if it isn't pinned anywhere
+    scope = set()
+    for highlight in plan.highlights:
+        if highlight.is_global:
+            continue
+        for t, negate, arg in highlight.checks:
+            if t in ("guild", "channel", "exact_channel") and not negate:
+                scope |= arg
+                break
+        else:
+            return None
+    return frozenset(scope)
+
+def search(pattern, content):
+    return pattern.compiled and pattern.compiled.search(content)
+
+def record_of(message):
+    reply_to = None
+    if message.type == discord.MessageType.reply and message.reference.resolved:
+        reply_to = getattr(getattr(message.reference.resolved, "author", None), "id", None)
+    return MessageRecord(
+        message.content,
+        # test and explain work in DMs too
+        getattr(message.guild, "id", None),
+        message.channel.id,
+        getattr(message.channel, "parent_id", None),
+        message.author.id,
+        message.author.bot,
+        tuple(str(r.emoji) for r in message.reactions),
+        reply_to,
+    )
+
+def successes_of_message(plan, message, relevant_react=None, scan=None):
+    return successes_of_record(plan, record_of(message), relevant_react, scan)
+
+def value_of_check(t, arg, message, matched=search):
+    if t in ("literal", "regex"):
+        return matched(arg, message.content)
+    elif t == "react":
+        return arg in message.reactions
+    elif t == "guild":
+        return message.guild_id in arg
+    elif t in ("channel", "exact_channel"):
+        return message.channel_id in arg or t == "channel" and message.parent_id in arg
+    elif t == "author":
+        return message.author_id in arg
+    elif t == "bot":
+        return message.author_bot
+    elif t == "reply":
+        return message.reply_to in arg
+    assert False
+
+def successes_of_record(plan, message, relevant_react=None, scan=None):
+    successes = []
+    matched = scan.matched if scan else search
+    global_result = True
+
+    if plan.global_react:
+        relevant_react = None
+
+    for highlight in plan.highlights:
+        is_relevant = not relevant_react
+        for t, negate, arg in highlight.checks:
+            if t == "react":
+                is_relevant = is_relevant or arg == relevant_react
+            if bool(value_of_check(t, arg, message, matched)) != (not negate):
+                break
+        else:
+            if is_relevant and not highlight.is_global:
+                successes.append(highlight)
+            continue
+        if highlight.is_global:
+            global_result = False
+
+    return [x.name for x in successes if global_result or x.noglobal]
+
+def explain_of_message(plan, message, relevant_react=None):
+    # successes_of_message, but timing every check. the engine isn't used, so each pattern's own cost shows
+    record = record_of(message)
+    successes = []
+    explained = []
+    global_result = True
+
+    if plan.global_react:
+        relevant_react = None
+
+    for highlight in plan.highlights:
+        is_relevant = not relevant_react
+        steps = []
+        for check in highlight.checks:
+            t, negate, arg = check
+            if t == "react":
+                is_relevant = is_relevant or arg == relevant_react
+            start = time.perf_counter()
+            x = value_of_check(t, arg, record)
+            seconds = time.perf_counter() - start
+            text = t in ("literal", "regex")
+            steps.append(Step(
+                check,
+                bool(x) == (not negate),
+                seconds,
+                arg.compiled.programsize if text and arg.compiled else 0,
+                arg.key in pool.patterns if text else None,
+            ))
+            if not steps[-1].passed:
+                if highlight.is_global:
+                    global_result = False
+                break
+        else:
+            if is_relevant and not highlight.is_global:
+                successes.append(highlight)
+        explained.append((highlight, steps, is_relevant))
+
+    return [x.name for x in successes if global_result or x.noglobal], explained, global_result
@@ -0,0 +1,130 @@
+import asyncio
+import os
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import nullcontext
+
+
+SECONDS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+COUNTS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000)
+
+# set HIGHLIGHT_METRICS to anything to collect from startup, otherwise it can be turned on with the `metrics` command
+enabled = bool(os.environ.get("HIGHLIGHT_METRICS"))
+# how often the metrics file is rewritten, in seconds
+WRITE_INTERVAL = 30
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        # upper bound of the bucket the quantile falls in
+        seen = 0
+        for bound, n in zip(self.buckets, self.counts):
+            seen += n
+            if seen >= q * self.count:
+                return bound
+        return float("inf")
+
+# (name, label) -> value
+counters = defaultdict(int)
+histograms = {}
+# name -> function returning the current value
+gauges = {}
+
+
+def count(name, label=None, n=1):
+    if enabled:
+        counters[name, label] += n
+
+def observe(name, value, label=None, buckets=SECONDS):
+    if enabled:
+        try:
+            h = histograms[name, label]
+        except KeyError:
+            h = histograms[name, label] = Histogram(buckets)
+        h.observe(value)
+
+def gauge(name, f):
+    gauges[name] = f
+
+class Timer:
+    __slots__ = ("name", "label", "start")
+
+    def __init__(self, name, label):
+        self.name = name
+        self.label = label
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *_):
+        observe(self.name, time.perf_counter() - self.start, self.label)
+
+_null = nullcontext()
+
+def timer(label, name="stage_seconds"):
+    return Timer(name, label) if enabled else _null
+
+def reset():
+    counters.clear()
+    histograms.clear()
+
+
+def labelled(name, label, extra=""):
+    labels = ",".join(x for x in (f'label="{label}"' if label is not None else "", extra) if x)
+    return f"highlight_{name}{{{labels}}}" if labels else f"highlight_{name}"
+
+def prometheus():
+    lines = []
+    for name in sorted({n for n, _ in counters}):
+        lines.append(f"# TYPE highlight_{name}_total counter")
+        lines += [f"{labelled(f'{name}_total', l)} {v}" for (n, l), v in counters.items() if n == name]
+    for name, f in sorted(gauges.items()):
+        lines.append(f"# TYPE highlight_{name} gauge")
+        lines.append(f"highlight_{name} {f()}")
+    for name in sorted({n for n, _ in histograms}):
+        lines.append(f"# TYPE highlight_{name} histogram")
+        for (n, l), h in histograms.items():
+            if n != name:
+                continue
+            seen = 0
+            for bound, c in zip((*h.buckets, "+Inf"), h.counts):
+                seen += c
+                le = f'le="{bound}"'
+                lines.append(f"{labelled(f'{name}_bucket', l, le)} {seen}")
+            lines.append(f"{labelled(f'{name}_sum', l)} {h.sum}")
+            lines.append(f"{labelled(f'{name}_count', l)} {h.count}")
+    return "\n".join(lines) + "\n"
+
+def summary():
+    lines = []
+    for (name, label), v in sorted(counters.items(), key=str):
+        lines.append(f"{name}{f'[{label}]' if label else ''}: {v}")
+    for name, f in sorted(gauges.items()):
+        lines.append(f"{name}: {f()}")
+    for (name, label), h in sorted(histograms.items(), key=str):
+        mean = h.sum / h.count if h.count else 0
+        lines.append(f"{name}{f'[{label}]' if label else ''}: n={h.count} mean={mean:.4g} p50<={h.quantile(0.5)} p99<={h.quantile(0.99)}")
+    return "\n".join(lines)
+
+def write(path, text):
+    with open(f"{path}.new", "w") as f:
+        f.write(text)
+    os.replace(f"{path}.new", path)
+
+async def write_periodically(path, interval=WRITE_INTERVAL):
+    while True:
+        await asyncio.sleep(interval)
+        if enabled:
+            await asyncio.to_thread(write, path, prometheus())
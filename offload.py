@@ -0,0 +1,82 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from matching import successes_of_record, selectivity
+
+
+# where matching runs: "inline" on the event loop, or in a "thread" or "process" pool
+MODE = os.environ.get("HIGHLIGHT_MATCHING", "inline")
+WORKERS = int(os.environ.get("HIGHLIGHT_MATCH_WORKERS", 2))
+
+
+def match_all(plans, record, relevant_react, engine):
+    # the engine's scan is done here as well, so a thread does all of the searching
+    scan = engine.scan(record.content) if engine else None
+    return scan, [successes_of_record(plan, record, relevant_react, scan) for plan in plans]
+
+# user id -> plan, inside each worker process
+worker_plans = {}
+
+def match_in_worker(updates, ids, record, relevant_react):
+    worker_plans.update(updates)
+    # the engine stays in the main process, so every pattern is searched for directly here
+    return match_all([worker_plans[id] for id in ids], record, relevant_react, None)
+
+
+class Matcher:
+    """Runs the matching step for all of a message's candidates at once, either on the loop or in a pool.
+
+    RE2 releases the GIL while searching, so a thread pool keeps the loop responsive without copying anything.
+    A process pool is sent each plan once and afterwards only the message record. It can't use the guild's engine.
+    """
+
+    def __init__(self, mode=MODE, workers=WORKERS):
+        self.mode = mode
+        self.pools = []
+        if mode == "thread":
+            self.pools = [ThreadPoolExecutor(workers, thread_name_prefix="match")]
+        elif mode == "process":
+            # a pool per process, so we know which plans each of them already has
+            self.pools = [ProcessPoolExecutor(1) for _ in range(workers)]
+            self.sent = [{} for _ in self.pools]
+            self.turn = 0
+        elif mode != "inline":
+            raise ValueError(f"unknown matching mode {mode!r}")
+
+    async def match(self, plans, record, relevant_react=None, engine=None):
+        # plans: user id -> plan. returns the successes of each, in the same order
+        if self.mode == "inline":
+            scan, results = match_all(plans.values(), record, relevant_react, engine)
+        elif self.mode == "thread":
+            job = asyncio.get_running_loop().run_in_executor(self.pools[0], match_all, list(plans.values()), record, relevant_react, engine)
+            scan, results = await job
+        else:
+            scan, results = await self.match_in_process(plans, record, relevant_react)
+        if scan:
+            selectivity.observe(scan.hits)
+        return results
+
+    async def match_in_process(self, plans, record, relevant_react):
+        self.turn = i = (self.turn + 1) % len(self.pools)
+        pool, sent = self.pools[i], self.sent[i]
+        updates = {id: plan for id, plan in plans.items() if sent.get(id) is not plan}
+        try:
+            job = asyncio.get_running_loop().run_in_executor(pool, match_in_worker, updates, list(plans), record, relevant_react)
+            # if we're cancelled the job still runs, so the worker isn't left with half of an update
+            result = await asyncio.shield(job)
+        except BrokenProcessPool:
+            # the worker died and took its plans with it. the one replacing it is sent everything again
+            if self.pools[i] is pool:
+                pool.shutdown(wait=False)
+                self.pools[i] = ProcessPoolExecutor(1)
+                self.sent[i] = {}
+            raise
+        # only now do we know the worker has them
+        sent.update(updates)
+        return result
+
+    def shutdown(self):
+        for pool in self.pools:
+            pool.shutdown(wait=False, cancel_futures=True)
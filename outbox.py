@@ -0,0 +1,104 @@
+import asyncio
+import logging
+
+import discord
+
+import metrics
+
+
+# how long to wait for more highlights to the same person before sending them together
+COALESCE_WINDOW = 3
+# how many DMs are sent at once
+SENDERS = 4
+# how many highlights may be waiting before submitting more blocks
+MAX_PENDING = 1000
+MAX_RETRIES = 5
+
+log = logging.getLogger("highlight")
+
+
+def batches(items):
+    # discord allows 10 embeds with 6000 characters between them, plus 2000 characters of content
+    batch, size, length = [], 0, 0
+    for content, embed in items:
+        if batch and (len(batch) == 10 or size + len(embed) > 6000 or length + len(content) > 2000):
+            yield batch
+            batch, size, length = [], 0, 0
+        batch.append((content, embed))
+        size += len(embed)
+        length += len(content) + 1
+    if batch:
+        yield batch
+
+
+class Outbox:
+    """Queue of highlight DMs. Highlights to the same person close together in time are merged into one message."""
+
+    def __init__(self, window=COALESCE_WINDOW, senders=SENDERS, max_pending=MAX_PENDING):
+        self.window = window
+        self.senders = senders
+        self.slots = asyncio.Semaphore(max_pending)
+        # user id -> (user, [(content, embed)])
+        self.waiting = {}
+        self.ready = asyncio.Queue()
+        self.workers = []
+        self.pending = 0
+        self.sent = 0
+        self.dropped = 0
+        self.retried = 0
+
+    async def submit(self, user, content, embed):
+        if not self.workers:
+            self.workers = [asyncio.create_task(self.work()) for _ in range(self.senders)]
+
+        await self.slots.acquire()
+        self.pending += 1
+        try:
+            _, items = self.waiting[user.id]
+        except KeyError:
+            items = []
+            self.waiting[user.id] = user, items
+            asyncio.get_running_loop().call_later(self.window, self.flush, user.id)
+        items.append((content, embed))
+
+    def flush(self, user_id):
+        self.ready.put_nowait(self.waiting.pop(user_id))
+
+    async def work(self):
+        while True:
+            user, items = await self.ready.get()
+            try:
+                for batch in batches(items):
+                    try:
+                        await self.send(user, batch)
+                    except Exception:
+                        self.dropped += len(batch)
+                        log.exception("sending highlights failed")
+            except Exception:
+                log.exception("batching highlights failed")
+            finally:
+                # whatever happened, these are done with, so the senders and submitters don't wait on them forever
+                self.pending -= len(items)
+                for _ in items:
+                    self.slots.release()
+
+    async def send(self, user, batch):
+        content = "\n".join(c for c, _ in batch)
+        embeds = [e for _, e in batch]
+        for attempt in range(MAX_RETRIES + 1):
+            try:
+                with metrics.timer("send"):
+                    await user.send(content, embeds=embeds)
+            except discord.HTTPException as e:
+                # rate limits and server errors are worth another go, anything else (like closed DMs) won't change
+                if e.status != 429 and e.status < 500 or attempt == MAX_RETRIES:
+                    self.dropped += len(batch)
+                    return
+                self.retried += 1
+                await asyncio.sleep(2 ** attempt)
+            else:
+                self.sent += len(batch)
+                return
+
+    def stats(self):
+        return {"pending": self.pending, "waiting": len(self.waiting), "ready": self.ready.qsize(), "sent": self.sent, "dropped": self.dropped, "retried": self.retried}
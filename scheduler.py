@@ -0,0 +1,30 @@
+import asyncio
+from collections import defaultdict
+
+
+class Scheduler:
+    """Delayed deliveries keyed by (channel, user), so activity in the channel can cancel them."""
+
+    def __init__(self):
+        self.pending = defaultdict(set)
+        self.tasks = set()
+
+    def schedule(self, key, delay, fire):
+        def run():
+            timers = self.pending[key]
+            timers.discard(handle)
+            if not timers:
+                del self.pending[key]
+            task = asyncio.create_task(fire())
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+        handle = asyncio.get_running_loop().call_later(delay, run)
+        self.pending[key].add(handle)
+
+    def cancel(self, key):
+        for handle in self.pending.pop(key, ()):
+            handle.cancel()
+
+    def __len__(self):
+        return sum(map(len, self.pending.values()))
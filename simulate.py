@@ -0,0 +1,416 @@
+"""Replays a stream of gateway events through the bot's real handlers, against a fake Discord and a virtual clock.
+
+    python simulate.py --days 1 --users 200 --rate 0.2
+    python simulate.py --days 7 --record week.jsonl
+    python simulate.py --replay week.jsonl
+
+Waits like after_time and the debounce windows pass instantly, so a simulated day only takes as long as the work in it.
+"""
+
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import random
+import re
+import resource
+import selectors
+import tempfile
+import time
+from collections import Counter, deque
+from types import SimpleNamespace
+
+import discord
+
+import bench
+
+
+# when the simulated days start
+EPOCH = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+GUILD_ID = bench.GUILD_ID
+CHANNEL_IDS = bench.CHANNEL_IDS
+BOT_ID = 1
+# people who talk but have no triggers. synthetic author filters point at them
+LURKER_IDS = range(1000, 1100)
+USER_BASE = 2000
+# view channel, send messages and read message history
+EVERYONE = 1024 | 2048 | 65536
+# how much history the fake Discord keeps per channel
+HISTORY = 100
+# how often the loop lag probe and the memory sampler wake up, in simulated seconds
+PROBE_INTERVAL = 1
+SAMPLE_INTERVAL = 3600
+
+
+class VirtualSelector(selectors.DefaultSelector):
+    def select(self, timeout=None):
+        # anything that's really ready, like a thread finishing, goes first
+        ready = super().select(0)
+        if ready or timeout == 0:
+            return ready
+        if self.loop.working or timeout is None:
+            # a thread is busy, so its time has to pass for real
+            return super().select(0.001 if timeout is None else min(timeout, 0.001))
+        self.loop.skipped += timeout
+        return []
+
+class VirtualLoop(asyncio.SelectorEventLoop):
+    """An event loop whose clock skips straight to the next timer instead of waiting for it, unless a thread is busy."""
+
+    def __init__(self):
+        self.skipped = 0
+        self.working = 0
+        selector = VirtualSelector()
+        selector.loop = self
+        super().__init__(selector)
+        self.start = self.time()
+
+    def time(self):
+        return time.monotonic() + self.skipped
+
+    def run_in_executor(self, executor, func, *args):
+        future = super().run_in_executor(executor, func, *args)
+        self.working += 1
+        future.add_done_callback(self.done_working)
+        return future
+
+    def done_working(self, _):
+        self.working -= 1
+
+class VirtualTime:
+    """Stands in for the time module in the bot's modules."""
+
+    def __init__(self, loop):
+        self.loop = loop
+
+    def time(self):
+        return EPOCH.timestamp() + self.loop.time() - self.loop.start
+
+    def monotonic(self):
+        return self.loop.time()
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+def virtual_datetime(clock):
+    class VirtualDatetime(datetime.datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return datetime.datetime.fromtimestamp(clock.time(), tz)
+    return SimpleNamespace(datetime=VirtualDatetime, timezone=datetime.timezone, timedelta=datetime.timedelta)
+
+
+def user_data(id):
+    return {"id": str(id), "username": f"user{id}", "discriminator": "0", "global_name": None, "avatar": None, "bot": id == BOT_ID}
+
+def member_data(id):
+    return {"user": user_data(id), "roles": [], "joined_at": EPOCH.isoformat(), "deaf": False, "mute": False, "flags": 0}
+
+def guild_data(member_ids):
+    return {
+        "id": str(GUILD_ID),
+        "name": "Simulated",
+        "owner_id": str(BOT_ID),
+        "roles": [{"id": str(GUILD_ID), "name": "@everyone", "permissions": str(EVERYONE), "position": 0, "color": 0, "hoist": False, "managed": False, "mentionable": False, "flags": 0}],
+        "channels": [
+            {"id": str(id), "type": 0, "name": f"channel-{id}", "position": i, "permission_overwrites": [], "guild_id": str(GUILD_ID)}
+            for i, id in enumerate(CHANNEL_IDS)
+        ],
+        "members": [member_data(id) for id in (BOT_ID, *member_ids)],
+        "voice_states": [],
+        "member_count": len(member_ids) + 1,
+        "emojis": [],
+        "stickers": [],
+        "features": [],
+        "threads": [],
+    }
+
+def message_data(id, channel_id, author_id, content, guild=True):
+    data = {
+        "id": str(id),
+        "channel_id": str(channel_id),
+        "author": user_data(author_id),
+        "content": content,
+        "timestamp": discord.utils.snowflake_time(id).isoformat(),
+        "edited_timestamp": None,
+        "tts": False,
+        "mention_everyone": False,
+        "mentions": [],
+        "mention_roles": [],
+        "attachments": [],
+        "embeds": [],
+        "reactions": [],
+        "pinned": False,
+        "type": 0,
+        "flags": 0,
+    }
+    if guild:
+        data["guild_id"] = str(GUILD_ID)
+        data["member"] = {k: v for k, v in member_data(author_id).items() if k != "user"}
+    return data
+
+
+class World:
+    """What the fake Discord knows: recent messages in each channel, and the highlights that came out as DMs."""
+
+    def __init__(self, clock):
+        self.clock = clock
+        # channel id -> recent message payloads, oldest first
+        self.channels = {}
+        self.messages = {}
+        self.sequence = 0
+        self.latencies = []
+
+    def new_id(self):
+        self.sequence += 1
+        now = datetime.datetime.fromtimestamp(self.clock.time(), datetime.timezone.utc)
+        return discord.utils.time_snowflake(now) + self.sequence % 4096
+
+    def post(self, channel_id, author_id, content):
+        data = message_data(self.new_id(), channel_id, author_id, content)
+        history = self.channels.setdefault(channel_id, deque())
+        history.append(data)
+        self.messages[int(data["id"])] = data
+        if len(history) > HISTORY:
+            del self.messages[int(history.popleft()["id"])]
+        return data
+
+    def latest(self, channel_id):
+        history = self.channels.get(channel_id)
+        return history[-1] if history else None
+
+    def history(self, channel_id, limit, before=None, after=None):
+        # newest first, like the real thing
+        history = self.channels.get(int(channel_id), ())
+        if before:
+            found = [m for m in history if int(m["id"]) < int(before)][-limit:]
+        elif after:
+            found = [m for m in history if int(m["id"]) > int(after)][:limit]
+        else:
+            found = list(history)[-limit:]
+        return found[::-1]
+
+    def react(self, data, emoji):
+        for reaction in data["reactions"]:
+            if reaction["emoji"] == emoji:
+                reaction["count"] += 1
+                break
+        else:
+            data["reactions"].append({"emoji": emoji, "count": 1, "me": False, "me_burst": False, "burst_colors": [], "count_details": {"normal": 1, "burst": 0}})
+
+    def deliver(self, channel_id, payload):
+        now = self.clock.time()
+        for embed in payload.get("embeds") or []:
+            for field in embed.get("fields", []):
+                if m := re.search(r"/([0-9]+)$", field["value"]):
+                    self.latencies.append(now - discord.utils.snowflake_time(int(m[1])).timestamp())
+        return message_data(self.new_id(), channel_id, BOT_ID, payload.get("content") or "", guild=False)
+
+class FakeHTTP:
+    """Answers the REST calls the bot makes from the simulated world, with latency and a rate limit per route and channel."""
+
+    def __init__(self, world, latency, limit, per):
+        self.world = world
+        self.latency = latency
+        self.limit = limit
+        self.per = per
+        self.calls = Counter()
+        self.limited = 0
+        # (route, channel or user) -> times of recent calls
+        self.recent = {}
+
+    async def call(self, route, bucket):
+        self.calls[route] += 1
+        loop = asyncio.get_running_loop()
+        times = self.recent.setdefault((route, bucket), deque())
+        while True:
+            now = loop.time()
+            while times and times[0] <= now - self.per:
+                times.popleft()
+            if len(times) < self.limit:
+                break
+            # what discord.py does on a 429
+            self.limited += 1
+            await asyncio.sleep(times[0] + self.per - now)
+        times.append(now)
+        await asyncio.sleep(self.latency)
+
+    async def logs_from(self, channel_id, limit, before=None, after=None, around=None):
+        await self.call("logs_from", channel_id)
+        return self.world.history(channel_id, limit, before, after)
+
+    async def get_message(self, channel_id, message_id):
+        await self.call("get_message", channel_id)
+        return self.world.messages[int(message_id)]
+
+    async def start_private_message(self, user_id):
+        await self.call("start_private_message", user_id)
+        return {"id": str(self.world.new_id()), "type": 1, "recipients": [user_data(user_id)], "last_message_id": None}
+
+    async def send_message(self, channel_id, *, params):
+        await self.call("send_message", channel_id)
+        return self.world.deliver(channel_id, params.payload)
+
+    async def get_thread_members(self, channel_id, *args, **kwargs):
+        await self.call("get_thread_members", channel_id)
+        return []
+
+
+def synthetic_events(args, rng, speakers):
+    t = 0
+    end = args.days * 86400
+    while (t := t + rng.expovariate(args.rate)) < end:
+        channel, user = rng.choice(CHANNEL_IDS), rng.choice(speakers)
+        r = rng.random()
+        if r < 0.6:
+            yield {"t": t, "type": "message", "channel": channel, "user": user, "content": bench.synthetic_corpus(1, rng)[0]}
+        elif r < 0.8:
+            yield {"t": t, "type": "typing", "channel": channel, "user": user}
+        elif r < 0.95:
+            yield {"t": t, "type": "reaction", "channel": channel, "user": user, "emoji": rng.choice(bench.EMOJIS)}
+        else:
+            yield {"t": t, "type": "edit", "channel": channel, "user": user, "content": bench.synthetic_corpus(1, rng)[0]}
+
+def rss_kb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def dispatch(state, world, event):
+    channel_id, user_id = event["channel"], event["user"]
+    t = event["type"]
+    if t == "message":
+        state.parse_message_create(world.post(channel_id, user_id, event["content"]))
+    elif t == "typing":
+        state.parse_typing_start({
+            "channel_id": str(channel_id), "guild_id": str(GUILD_ID), "user_id": str(user_id),
+            "timestamp": int(world.clock.time()), "member": member_data(user_id),
+        })
+    elif not (target := world.latest(channel_id)):
+        return
+    elif t == "reaction":
+        emoji = discord.PartialEmoji.from_str(event["emoji"]).to_dict()
+        world.react(target, emoji)
+        state.parse_message_reaction_add({
+            "user_id": str(user_id), "channel_id": str(channel_id), "message_id": target["id"], "guild_id": str(GUILD_ID),
+            "emoji": emoji, "member": member_data(user_id), "type": 0, "burst": False, "burst_colors": [],
+        })
+    elif t == "edit":
+        target["content"] = event["content"]
+        target["edited_timestamp"] = datetime.datetime.fromtimestamp(world.clock.time(), datetime.timezone.utc).isoformat()
+        state.parse_message_update(dict(target))
+
+async def simulate(main, args, events, world):
+    bot = main.bot
+    state = bot._connection
+    loop = asyncio.get_running_loop()
+    await bot._async_setup_hook()
+    state.user = discord.ClientUser(state=state, data=user_data(BOT_ID))
+    state._add_guild_from_data(guild_data([int(id) for id in main.config] + list(LURKER_IDS)))
+
+    await main.warm_plans()
+    await main.on_ready()
+
+    lags = []
+    memory = []
+    async def probe():
+        while True:
+            start = loop.time()
+            await asyncio.sleep(PROBE_INTERVAL)
+            lags.append(loop.time() - start - PROBE_INTERVAL)
+    async def sample():
+        while True:
+            memory.append(rss_kb())
+            await asyncio.sleep(SAMPLE_INTERVAL)
+    background = [asyncio.create_task(probe()), asyncio.create_task(sample())]
+
+    counts = Counter()
+    start = loop.time()
+    for event in events:
+        if (wait := start + event["t"] - loop.time()) > 0:
+            await asyncio.sleep(wait)
+        dispatch(state, world, event)
+        counts[event["type"]] += 1
+    # let everything that was scheduled go out
+    while len(main.inbox) or len(main.scheduler) or main.outbox.pending:
+        await asyncio.sleep(1)
+    memory.append(rss_kb())
+    for task in background:
+        task.cancel()
+
+    return counts, lags, memory, loop.time() - start
+
+
+def percentiles(samples, scale=1):
+    if not samples:
+        return {"n": 0}
+    samples = sorted(samples)
+    at = lambda q: samples[min(len(samples) - 1, int(len(samples) * q))] * scale
+    return {"n": len(samples), "p50": at(0.5), "p90": at(0.9), "p99": at(0.99), "max": samples[-1] * scale}
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay gateway events through the bot against a fake Discord and a virtual clock.")
+    parser.add_argument("--days", type=float, default=1)
+    parser.add_argument("--rate", type=float, default=0.2, help="events per simulated second")
+    parser.add_argument("--users", type=int, default=200, help="how many users have triggers")
+    parser.add_argument("--triggers", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--latency", type=float, default=0.05, help="how long each fake REST call takes")
+    parser.add_argument("--limit", type=int, default=5, help="calls allowed per route and channel in each --per seconds")
+    parser.add_argument("--per", type=float, default=5)
+    parser.add_argument("--record", metavar="FILE", help="write the events to FILE, one JSON object per line")
+    parser.add_argument("--replay", metavar="FILE", help="replay recorded events from FILE instead of generating them")
+    parser.add_argument("--metrics", action="store_true", help="also print the bot's own metrics")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    directory = tempfile.mkdtemp(prefix="highlight-sim-")
+    config = {str(USER_BASE + int(id)): user for id, user in bench.synthetic_config(args.users, args.triggers, rng).items()}
+    with open(os.path.join(directory, "config.json"), "w") as f:
+        json.dump(config, f)
+    os.environ["HIGHLIGHT_CONFIG"] = os.path.join(directory, "config.db")
+    os.environ["HIGHLIGHT_METRICS"] = "1"
+    import main as bot_main
+    import activity
+    import context
+
+    if args.replay:
+        with open(args.replay) as f:
+            events = [json.loads(line) for line in f]
+    else:
+        events = list(synthetic_events(args, rng, [int(id) for id in config] + list(LURKER_IDS)))
+    if args.record:
+        with open(args.record, "w") as f:
+            f.writelines(json.dumps(e) + "\n" for e in events)
+
+    loop = VirtualLoop()
+    asyncio.set_event_loop(loop)
+    clock = VirtualTime(loop)
+    for module in (bot_main, activity, context):
+        module.time = clock
+    bot_main.datetime = virtual_datetime(clock)
+    world = World(clock)
+    http = FakeHTTP(world, args.latency, args.limit, args.per)
+    bot_main.bot.http = bot_main.bot._connection.http = http
+
+    started = time.perf_counter()
+    counts, lags, memory, simulated = loop.run_until_complete(simulate(bot_main, args, events, world))
+    elapsed = time.perf_counter() - started
+    bot_main.matcher.shutdown()
+
+    days = simulated / 86400
+    print(f"simulated {days:.2f} days in {elapsed:.1f}s: " + ", ".join(f"{n} {t} events" for t, n in counts.items()))
+    print("delivery_latency_s  " + "  ".join(f"{k}={v:.3f}" if isinstance(v, float) else f"{k}={v}" for k, v in percentiles(world.latencies).items()))
+    print("loop_lag_ms         " + "  ".join(f"{k}={v:.3f}" if isinstance(v, float) else f"{k}={v}" for k, v in percentiles(lags, 1000).items()))
+    per_message = sum(http.calls.values()) / max(counts["message"], 1)
+    print(f"rest_calls          total={sum(http.calls.values())}  per_message={per_message:.3f}  rate_limited={http.limited}  " + "  ".join(f"{k}={v}" for k, v in sorted(http.calls.items())))
+    print(f"memory_kb           start={memory[0]}  end={memory[-1]}  growth_per_day={(memory[-1] - memory[0]) / max(days, 1e-9):.0f}")
+    if args.metrics:
+        print(bot_main.metrics.summary())
+
+if __name__ == "__main__":
+    main()
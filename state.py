@@ -0,0 +1,137 @@
+import asyncio
+import logging
+from collections import defaultdict
+
+import discord
+
+
+class ThreadMembers:
+    """Who is in each private thread, fetched once per thread and then kept current from gateway events."""
+
+    def __init__(self):
+        # thread id -> set of user ids, or a task still fetching them
+        self.threads = {}
+
+    async def get(self, thread):
+        entry = self.threads.get(thread.id)
+        if entry is None:
+            entry = self.threads[thread.id] = asyncio.create_task(self.fetch(thread))
+        if isinstance(entry, set):
+            return entry
+        try:
+            return await asyncio.shield(entry)
+        except Exception:
+            if self.threads.get(thread.id) is entry:
+                del self.threads[thread.id]
+            raise
+
+    async def fetch(self, thread):
+        members = {m.id for m in await thread.fetch_members()}
+        self.threads[thread.id] = members
+        return members
+
+    def join(self, thread_id, user_id):
+        if isinstance(members := self.threads.get(thread_id), set):
+            members.add(user_id)
+
+    def leave(self, thread_id, user_id):
+        if isinstance(members := self.threads.get(thread_id), set):
+            members.discard(user_id)
+
+    def forget(self, thread_id):
+        self.threads.pop(thread_id, None)
+
+
+# how long to gather newly configured users before asking for them
+FETCH_DELAY = 2
+# the most user ids one member query can ask for
+QUERY_SIZE = 100
+
+log = logging.getLogger("highlight")
+
+
+class ConfiguredMembers:
+    """Fetches members into the cache from the gateway in bulk, for when discord.py isn't caching them itself."""
+
+    def __init__(self, guilds, found):
+        # guilds returns every guild we're in, and found is called with each guild and the members found in it
+        self.guilds = guilds
+        self.found = found
+        self.waiting = set()
+        self.task = None
+        self.running = set()
+
+    async def fetch(self, guild, ids):
+        ids = list(ids)
+        members = []
+        for i in range(0, len(ids), QUERY_SIZE):
+            try:
+                members += await guild.query_members(user_ids=ids[i:i+QUERY_SIZE], limit=QUERY_SIZE, cache=True)
+            except asyncio.TimeoutError:
+                pass
+            except Exception:
+                log.exception("fetching members of guild %d failed", guild.id)
+        if members:
+            self.found(guild, members)
+        return members
+
+    def start(self, guild, ids):
+        # in the background, so nothing has to wait for the gateway
+        task = asyncio.create_task(self.fetch(guild, ids))
+        self.running.add(task)
+        task.add_done_callback(self.running.discard)
+
+    async def fetch_all(self, guilds, ids):
+        await asyncio.gather(*(self.fetch(guild, ids) for guild in guilds))
+
+    def request(self, ids):
+        # we don't know which guilds they're in, so every guild is asked, but only once per batch
+        self.waiting.update(ids)
+        if not self.task or self.task.done():
+            self.task = asyncio.create_task(self.fetch_waiting())
+
+    async def fetch_waiting(self):
+        # ids requested while a batch is out go in the next one, since request won't start another task while this one runs
+        while self.waiting:
+            await asyncio.sleep(FETCH_DELAY)
+            ids, self.waiting = self.waiting, set()
+            await self.fetch_all(self.guilds(), ids)
+
+
+class PermissionCache:
+    """Channel permissions by role set, since most members of a guild share a handful of role combinations."""
+
+    def __init__(self):
+        # guild id -> channel (or thread parent) id -> key -> permissions
+        self.guilds = defaultdict(lambda: defaultdict(dict))
+        # channel id -> ids of members with their own overwrite in it
+        self.member_overwrites = {}
+
+    def get(self, channel, member):
+        source = channel.parent if isinstance(channel, discord.Thread) and channel.parent else channel
+        try:
+            overwrites = self.member_overwrites[source.id]
+        except KeyError:
+            overwrites = self.member_overwrites[source.id] = frozenset(t.id for t in source.overwrites if not isinstance(t, discord.Role))
+
+        key = (
+            channel.id,
+            tuple(sorted(r.id for r in member.roles)),
+            member.id if member.id in overwrites else None,
+            member.id == channel.guild.owner_id,
+            member.is_timed_out(),
+        )
+        entries = self.guilds[channel.guild.id][source.id]
+        try:
+            return entries[key]
+        except KeyError:
+            perms = entries[key] = channel.permissions_for(member)
+            return perms
+
+    def forget_guild(self, guild_id):
+        for channel_id in self.guilds.pop(guild_id, {}):
+            self.member_overwrites.pop(channel_id, None)
+
+    def forget_channel(self, guild_id, channel_id):
+        self.guilds[guild_id].pop(channel_id, None)
+        self.member_overwrites.pop(channel_id, None)
@@ -0,0 +1,239 @@
+import asyncio
+import json
+import marshal
+import os
+import sqlite3
+from collections import defaultdict
+from collections.abc import Mapping
+
+import metrics
+
+
+# how long edits are gathered before they're written out together
+FLUSH_DELAY = 2
+
+
+class JsonBackend:
+    """The original format: the whole config in one file, rewritten on every commit."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def commit(self, users, dirty_users, dirty_highlights, removed):
+        with open(f"{self.path}.new", "w") as f:
+            json.dump(users, f)
+        os.replace(f"{self.path}.new", self.path)
+
+    def close(self, users):
+        pass
+
+class SqliteBackend:
+    """One row per user and one per highlight, so a commit only touches what changed.
+
+    On shutdown the whole config is also dumped to a marshal snapshot, which loads several times faster than the tables.
+    It's only used if nothing was committed after it was written.
+    """
+
+    def __init__(self, path, import_from=None):
+        fresh = not os.path.exists(path)
+        self.snapshot_path = f"{path}.snapshot"
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        with self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS users (id INTEGER PRIMARY KEY, data TEXT NOT NULL)")
+            self.db.execute("""
+                CREATE TABLE IF NOT EXISTS highlights (
+                    user_id INTEGER NOT NULL,
+                    name TEXT NOT NULL,
+                    position INTEGER NOT NULL,
+                    filters TEXT NOT NULL,
+                    noglobal INTEGER NOT NULL,
+                    PRIMARY KEY (user_id, name)
+                )
+            """)
+            self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        if fresh and import_from and os.path.exists(import_from):
+            self.import_json(import_from)
+
+    def import_json(self, path):
+        users = JsonBackend(path).load()
+        self.commit(users, users, {(id, h["name"]) for id, user in users.items() for h in user["highlights"]}, set())
+
+    def generation(self):
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()
+        return row[0] if row else 0
+
+    def load(self):
+        try:
+            with open(self.snapshot_path, "rb") as f:
+                generation, users = marshal.load(f)
+        except (OSError, EOFError, ValueError, TypeError):
+            pass
+        else:
+            if generation == self.generation():
+                return users
+
+        users = {}
+        for id, data in self.db.execute("SELECT id, data FROM users"):
+            users[str(id)] = {**json.loads(data), "highlights": []}
+        for id, name, filters, noglobal in self.db.execute("SELECT user_id, name, filters, noglobal FROM highlights ORDER BY user_id, position"):
+            users.setdefault(str(id), {"highlights": []})["highlights"].append({"name": name, "filters": json.loads(filters), "noglobal": bool(noglobal)})
+        return users
+
+    def commit(self, users, dirty_users, dirty_highlights, removed):
+        # removed: highlights removed since the last commit, which may have been added back since and belong at the end now
+        with self.db:
+            for id in dirty_users:
+                data = {k: v for k, v in users[id].items() if k != "highlights"}
+                self.db.execute("INSERT OR REPLACE INTO users (id, data) VALUES (?, ?)", (int(id), json.dumps(data)))
+
+            for id, name in removed:
+                self.db.execute("DELETE FROM highlights WHERE user_id = ? AND name = ?", (int(id), name))
+
+            dirty_names = defaultdict(set)
+            for id, name in dirty_highlights:
+                dirty_names[id].add(name)
+            for id, names in dirty_names.items():
+                # the user's own list is walked, so new highlights are appended in the order they were added
+                for h in users[id]["highlights"] if id in users else ():
+                    if h["name"] not in names:
+                        continue
+                    # new highlights go at the end; updated ones keep their place
+                    self.db.execute("""
+                        INSERT INTO highlights (user_id, name, position, filters, noglobal)
+                        VALUES (?1, ?2, (SELECT COALESCE(MAX(position), -1) + 1 FROM highlights WHERE user_id = ?1), ?3, ?4)
+                        ON CONFLICT (user_id, name) DO UPDATE SET filters = excluded.filters, noglobal = excluded.noglobal
+                    """, (int(id), h["name"], json.dumps(h["filters"]), h["noglobal"]))
+                    names.discard(h["name"])
+                for name in names:
+                    self.db.execute("DELETE FROM highlights WHERE user_id = ? AND name = ?", (int(id), name))
+
+            # any snapshot is out of date now
+            self.db.execute("INSERT INTO meta (key, value) VALUES ('generation', 1) ON CONFLICT (key) DO UPDATE SET value = value + 1")
+
+    def close(self, users):
+        with open(f"{self.snapshot_path}.new", "wb") as f:
+            marshal.dump((self.generation(), users), f)
+        os.replace(f"{self.snapshot_path}.new", self.snapshot_path)
+        self.db.close()
+
+
+class Config(Mapping):
+    """Every user's settings and triggers. Reads come from memory, and changes are written to the backend in batches."""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.users = backend.load()
+        self.dirty_users = set()
+        self.dirty_highlights = set()
+        self.removed_highlights = set()
+        self.timer = None
+
+    def __getitem__(self, id):
+        return self.users[id]
+
+    def __iter__(self):
+        return iter(self.users)
+
+    def __len__(self):
+        return len(self.users)
+
+    def user(self, id):
+        if id not in self.users:
+            self.users[id] = {"highlights": []}
+            self.dirty_users.add(id)
+            self.changed()
+        return self.users[id]
+
+    def set_option(self, id, key, value):
+        self.user(id)[key] = value
+        self.dirty_users.add(id)
+        self.changed()
+
+    def put_highlight(self, id, name, filters, noglobal):
+        highlights = self.user(id)["highlights"]
+        for highlight in highlights:
+            if highlight["name"] == name:
+                highlight["filters"] = filters
+                highlight["noglobal"] = noglobal
+                break
+        else:
+            highlights.append({"name": name, "filters": filters, "noglobal": noglobal})
+        self.dirty_highlights.add((id, name))
+        self.changed()
+
+    def put_highlights(self, id, triggers):
+        # triggers: name -> (filters, noglobal)
+        highlights = self.user(id)["highlights"]
+        existing = {h["name"]: h for h in highlights}
+        for name, (filters, noglobal) in triggers.items():
+            if highlight := existing.get(name):
+                highlight["filters"] = filters
+                highlight["noglobal"] = noglobal
+            else:
+                highlights.append({"name": name, "filters": filters, "noglobal": noglobal})
+        self.dirty_highlights.update((id, name) for name in triggers)
+        self.changed()
+
+    def remove_highlights(self, id, names):
+        if id not in self.users:
+            return
+        highlights = self.users[id]["highlights"]
+        highlights[:] = [h for h in highlights if h["name"] not in names]
+        self.dirty_highlights.update((id, name) for name in names)
+        self.removed_highlights.update((id, name) for name in names)
+        self.changed()
+
+    def clear_highlights(self, id):
+        self.remove_highlights(id, {h["name"] for h in self.user(id)["highlights"]})
+
+    def block(self, id, target):
+        blocked = self.user(id).setdefault("blocked", [])
+        if target in blocked:
+            return False
+        blocked.append(target)
+        self.dirty_users.add(id)
+        self.changed()
+        return True
+
+    def unblock(self, id, target):
+        blocked = self.user(id).setdefault("blocked", [])
+        if target not in blocked:
+            return False
+        blocked.remove(target)
+        self.dirty_users.add(id)
+        self.changed()
+        return True
+
+    def changed(self):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.flush()
+            return
+        if not self.timer:
+            self.timer = loop.call_later(FLUSH_DELAY, self.flush)
+
+    def flush(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        if not self.dirty_users and not self.dirty_highlights:
+            return
+        with metrics.timer("save"):
+            self.backend.commit(self.users, self.dirty_users, self.dirty_highlights, self.removed_highlights)
+        self.dirty_users = set()
+        self.dirty_highlights = set()
+        self.removed_highlights = set()
+
+    def close(self):
+        self.flush()
+        self.backend.close(self.users)
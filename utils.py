@@ -1,29 +1,127 @@
+import time
+from collections import Counter, OrderedDict
 from typing import Any
 
 import re2 as re
 from parse_discord import *
 
+import metrics
+
 
 def render_pattern(pattern, flags):
     return f"/{pattern}/{flags}"    
 
-regex_cache = {}
-def matches(regex, content, flags):
-    key = (regex, flags)
+def options_of(flags):
+    options = re.Options()
+    if "i" in flags:
+        options.case_sensitive = False
+    if "s" in flags:
+        options.dot_nl = True
+    options.never_capture = True
+    return options
 
-    try:
-        o = regex_cache[key]
-    except KeyError:
-        options = re.Options()
-        if "i" in flags:
-            options.case_sensitive = False
-        if "s" in flags:
-            options.dot_nl = True
-        options.never_capture = True
-        o = re.compile(regex, options)
-        regex_cache[key] = o
+# total RE2 program size the pattern pool may hold before unpinned patterns are evicted
+POOL_BUDGET = 1_000_000
+# how many characters of a message are shown in a highlight
+DISPLAY_LENGTH = 700
+# how many rendered messages are kept
+RENDER_CACHE_SIZE = 2000
+
+class PatternPool:
+    """Compiled patterns, shared between everyone who uses the same (pattern, flags).
+
+    Patterns used by active triggers are pinned. The rest are evicted least recently used first once the total program size goes over budget.
+    """
+
+    def __init__(self, budget=POOL_BUDGET):
+        self.budget = budget
+        self.patterns = OrderedDict()
+        self.pins = Counter()
+        self.size = 0
+        # the part of size that is pinned, and so can't be evicted
+        self.pinned_size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.compile_seconds = 0.0
+
+    def get(self, regex, flags, pin=False):
+        # pin is for patterns compiled into a plan, so they're pinned before anything can be evicted to make room for them
+        key = (regex, flags)
+        try:
+            o = self.patterns[key]
+        except KeyError:
+            pass
+        else:
+            self.patterns.move_to_end(key)
+            self.hits += 1
+            metrics.count("regex_cache", "hit")
+            if pin:
+                self.pin([key])
+            return o
+
+        self.misses += 1
+        metrics.count("regex_cache", "miss")
+        start = time.perf_counter()
+        o = re.compile(regex, options_of(flags))
+        self.compile_seconds += time.perf_counter() - start
+        self.patterns[key] = o
+        self.size += o.programsize
+        if pin:
+            self.pin([key])
+        self.evict()
+        return o
+
+    def evict(self):
+        while self.size > self.budget and self.size > self.pinned_size:
+            key = next(iter(self.patterns))
+            if self.pins[key]:
+                # in use, so it goes to the back where the next scan won't have to pass it
+                self.patterns.move_to_end(key)
+                continue
+            self.size -= self.patterns.pop(key).programsize
+            self.evictions += 1
+            metrics.count("regex_cache", "eviction")
+
+    def pin(self, keys):
+        for key in keys:
+            if not self.pins[key] and key in self.patterns:
+                self.pinned_size += self.patterns[key].programsize
+            self.pins[key] += 1
+
+    def unpin(self, keys):
+        for key in keys:
+            self.pins[key] -= 1
+            if self.pins[key] <= 0:
+                del self.pins[key]
+                if key in self.patterns:
+                    self.pinned_size -= self.patterns[key].programsize
+        self.evict()
+
+    def clear(self):
+        self.patterns.clear()
+        self.pins.clear()
+        self.size = 0
+        self.pinned_size = 0
+
+    def stats(self):
+        return {
+            "patterns": len(self.patterns),
+            "pinned": len(self.pins),
+            "program_size": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "compile_seconds": self.compile_seconds,
+        }
+
+pool = PatternPool()
 
-    return o.search(content)
+def compile_pattern(regex, flags, pin=False):
+    return pool.get(regex, flags, pin)
+
+def matches(regex, content, flags):
+    return compile_pattern(regex, flags).search(content)
 
 def english_list(l, merger="and"):
     if len(l) == 1:
@@ -49,7 +147,77 @@ def truncate(markup, to):
                     to = truncate(inner, to)
     return to
 
-def display_message(text):
-    m = parse(text)
-    truncated = truncate(m, 700) < 0
-    return f"{m}{'...'*truncated}"
+def prefix_of(text, size):
+    # cut at a line break (or failing that a space) so markup is less likely to be split,
+    # and never inside a code block, which would swallow everything after it
+    end = text.rfind("\n", size // 2, size)
+    if end == -1:
+        end = text.rfind(" ", size // 2, size)
+    if end == -1:
+        end = size
+    if text.count("```", 0, end) % 2:
+        close = text.find("```", end)
+        return text if close == -1 else text[:close+3]
+    return text[:end]
+
+# what a delimiter left as plain text in a prefix looks like when it could still open something, and the characters that would have to come after the cut to close it
+OPENERS = [
+    (re.compile(r"\*(\S|$)"), "*"),
+    (re.compile(r"__|(^|\W)_"), "_"),
+    (re.compile(r"~~"), "~"),
+    (re.compile(r"\|\|"), "|"),
+    (re.compile(r"`"), "`"),
+    # a masked link whose label or url is still open at the cut
+    (re.compile(r"\[[^\]]*$|\]\([^)\s]*$"), "])"),
+]
+
+def plain_text(markup):
+    o = []
+    for node in markup.nodes:
+        match node:
+            case Text(c):
+                o.append(c)
+            case Codeblock() | InlineCode():
+                pass
+            case _:
+                o.extend(plain_text(inner) for inner in node.inners)
+    return "".join(o)
+
+def unclosed(markup, rest):
+    # whether a delimiter the prefix left unpaired could pair with one after the cut, which would change how the prefix reads
+    plain = plain_text(markup)
+    return any(any(c in rest for c in closers) and opener.search(plain) for opener, closers in OPENERS)
+
+def display_message(text, to=DISPLAY_LENGTH):
+    # parse a prefix big enough to fill the budget, only growing it when the markup turns out to be denser than that
+    size = to * 2
+    while True:
+        m = parse(prefix := text if len(text) <= size else prefix_of(text, size))
+        if prefix is not text and unclosed(m, text[len(prefix):]):
+            m = parse(prefix := text)
+        left = truncate(m, to)
+        if left < 0 or prefix is text:
+            break
+        size *= 2
+    return f"{m}{'...'*(left < 0)}"
+
+# message id -> (content, rendered)
+rendered = OrderedDict()
+
+def display_cached(message):
+    # the same context messages are shown to everyone highlighted around them
+    try:
+        content, text = rendered[message.id]
+    except KeyError:
+        pass
+    else:
+        if content == message.content:
+            rendered.move_to_end(message.id)
+            metrics.count("render_cache", "hit")
+            return text
+    metrics.count("render_cache", "miss")
+    text = display_message(message.content)
+    rendered[message.id] = message.content, text
+    if len(rendered) > RENDER_CACHE_SIZE:
+        rendered.popitem(last=False)
+    return text